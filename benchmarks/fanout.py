@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+'''Channel fan-out benchmark.
+
+Measures the per-recipient cost of delivering one PRIVMSG to every member of
+a channel, comparing the old path (raw_send per member, which re-encodes the
+line each time) with notify_channel's encode-once broadcast.
+
+Members are real clients connected over loopback, and each round runs
+the reactor until every queue has been written out and read back by the
+peer, so the figures include the queue, sendmsg and the kernel.  A round
+with nothing queued is subtracted as the baseline.
+
+$ python3 benchmarks/fanout.py [members ...]
+'''
+import os
+import resource
+import selectors
+import socket
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from irked import IrcDispatcher
+from irc.channel import Channel
+
+DEFAULT_SIZES = [10, 100, 1000, 5000]
+MESSAGE = 'PRIVMSG #bench :' + 'the quick brown fox jumps over the lazy dog ' * 2
+CONFIG = '''
+[server]
+name = bench.server
+resolve_hosts = no
+[log]
+log_file = %s
+log_level = WARNING
+[flood]
+enabled = no
+'''
+
+def make_server(directory):
+    config = os.path.join(directory, 'bench.conf')
+    with open(config, 'w') as config_file:
+        config_file.write(CONFIG % os.path.join(directory, 'bench.log'))
+    return IrcDispatcher(host='127.0.0.1', port=0, config=config)
+
+def make_members(server, members):
+    '''Connect and register members clients, returning a selector holding
+    the client ends.'''
+    peers = selectors.DefaultSelector()
+    for i in range(members):
+        theirs = socket.create_connection(server.getsockname())
+        theirs.setblocking(False)
+        theirs.sendall(b'NICK nick%d\r\nUSER nick%d 0 * :bench\r\n' % (i, i))
+        peers.register(theirs, selectors.EVENT_READ)
+        if i % 100 == 99:
+            register(server, peers, i + 1)
+    register(server, peers, members)
+    return peers
+
+def register(server, peers, clients):
+    while len(server.clients) < clients:
+        flush(server, peers)
+    flush(server, peers)
+
+def flush(server, peers):
+    '''Run the reactor until a pass produces no output, reading what it
+    wrote back on the peers.  Only peers with data are visited, so an
+    empty round costs the same whatever the channel size.'''
+    while True:
+        server.reactor.poll(0)
+        ready = peers.select(0)
+        if not ready and not server.reactor.pending:
+            return
+        for key, mask in ready:
+            try:
+                while key.fileobj.recv(1 << 20):
+                    pass
+            except BlockingIOError:
+                pass
+
+def measure(members, directory, repeat=5):
+    server = make_server(directory)
+    peers = make_members(server, members)
+    channel = Channel('#bench', server)
+    channel.clients = set(server.clients.values())
+    server.channels['#bench'] = channel
+    sender = next(iter(channel.clients))
+    number = max(1, 20000 // members)
+
+    def legacy():
+        prefixed_message = '%s %s\r\n' % (sender.prefix(), MESSAGE)
+        for client in channel.clients:
+            if client is sender:
+                continue
+            client.connection.raw_send(prefixed_message)
+        flush(server, peers)
+
+    def broadcast():
+        server.notify_channel('#bench', sender, MESSAGE, notify_sender=False)
+        flush(server, peers)
+
+    def baseline():
+        flush(server, peers)
+
+    results = []
+    for function in (baseline, legacy, broadcast):
+        best = min(timeit.repeat(function, number=number, repeat=repeat))
+        results.append(best / number)
+    for key in list(peers.get_map().values()):
+        key.fileobj.close()
+    peers.close()
+    for connection in list(server.connections):
+        connection.close()
+    server.close()
+    base, old, new = results
+    per_recipient = lambda total: (total - base) / (members - 1) * 1e9
+    return per_recipient(old), per_recipient(new)
+
+def main(sizes):
+    # two descriptors per member
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    print('%8s %16s %17s %8s' % ('members', 'raw_send ns/rcpt',
+                                 'broadcast ns/rcpt', 'speedup'))
+    with tempfile.TemporaryDirectory() as directory:
+        for members in sizes:
+            if 2 * members + 64 > limit:
+                print('%8d skipped, needs more than %d open files' %
+                      (members, limit))
+                continue
+            old, new = measure(members, directory)
+            print('%8d %16.1f %17.1f %7.2fx' % (members, old, new, old / new))
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+'''Message parser benchmark.
+
+Compares irc.parser.parse with the regex based parser IrcHandler used
+before, over a corpus of typical client and server lines.
+
+$ python3 benchmarks/parse.py [iterations]
+'''
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from irc.parser import parse
+
+CORPUS = [
+    'NICK alice',
+    'USER alice 0 * :Alice Liddell',
+    'JOIN #python,#irked',
+    'PART #irked :see you later',
+    'PRIVMSG #irked :has anyone tried the new reactor yet?',
+    'PRIVMSG bob :hey, are you around? ping me: when you can',
+    'NOTICE #irked :build 1234 passed',
+    'MODE #irked +o bob',
+    'MODE #irked +k secret:key',
+    'TOPIC #irked :irked development | http://example.com/irked',
+    'WHO #irked o',
+    'WHOIS bob',
+    'PING irked.server',
+    'PONG :irked.server',
+    'QUIT :Leaving',
+    ':bob!bob@example.com PRIVMSG #irked :sure, it works for me',
+    ':bob!bob@example.com JOIN #irked',
+    ':irked.server 001 alice :Welcome to the Internet Relay Network',
+    ':other.server NICK carol 1 carol host.example.com 42 +i :Carol',
+    ':other.server SERVER leaf.server 2 17 :Leaf server',
+]
+
+def legacy_parse(message):
+    '''IrcHandler.parse before irc.parser was introduced.'''
+    prefix = None
+    match = re.match(':([^ ]+) +', message)
+    if match:
+        prefix  = match.groups()[0]
+        message = message[match.end():]
+
+    trailing = None
+    match = re.search(':(.*)$', message)
+    if match:
+        trailing = match.groups()[0]
+        message = message[:match.start()]
+
+    params  = message.split()
+    if trailing != None:
+        params.append(trailing)
+
+    command = params[0].upper()
+    params = params[1:]
+
+    return (prefix, command, params)
+
+def run(function, iterations):
+    def parse_corpus():
+        for line in CORPUS:
+            function(line)
+    best = min(timeit.repeat(parse_corpus, number=iterations, repeat=5))
+    return best / (iterations * len(CORPUS)) * 1e9
+
+def main(iterations):
+    mismatches = [line for line in CORPUS
+                  if tuple(parse(line)) != legacy_parse(line)]
+    old = run(legacy_parse, iterations)
+    new = run(parse, iterations)
+    print('%d lines x %d iterations' % (len(CORPUS), iterations))
+    print('%-14s %8.1f ns/line' % ('legacy regex', old))
+    print('%-14s %8.1f ns/line' % ('irc.parser', new))
+    print('speedup        %8.2fx' % (old / new))
+    for line in mismatches:
+        print('differs from legacy: %r' % line)
+        print('    legacy: %r' % (legacy_parse(line),))
+        print('    parser: %r' % (tuple(parse(line)),))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
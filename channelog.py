@@ -1,26 +1,303 @@
+'''Logs channel messages to an SQLite database, for the dashboard and for
+channel history.
+
+Messages are queued by the event loop and written by a background thread,
+which commits them in batches of up to batch_size rows, or every
+flush_interval seconds, whichever comes first.  When the queue holds
+max_queue rows, further messages are dropped (and counted) rather than
+holding up the server.
+
+History is read back through the (channel, timestamp) index: the last
+`replay` lines are sent to clients joining a channel, and HISTORY asks for
+up to history_max lines at a time.  Messages still queued for the writer
+are not part of it yet.  Every day the writer deletes, one day at a time,
+the rows older than retention_days (0 keeps everything).  The writer builds
+the index when it starts, and rebuilds a database created without
+incremental auto_vacuum once, so both can take a while on a large file.
+
+    [channelog]
+    db = dashboard/dashboard.db
+    batch_size = 500
+    flush_interval = 1.0
+    max_queue = 10000
+    replay = 20
+    history_max = 200
+    retention_days = 30
+'''
+import logging
+import queue
 import sqlite3
+import threading
 import time
-DB = None
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+MAX_QUEUE = 10000
+# lines replayed on JOIN, and most lines returned by one history request
+REPLAY = 20
+HISTORY_MAX = 200
+RETENTION_DAYS = 30
+DAY = 86400
+WRITER = None
+READER = None
+OPTIONS = None
+logger = logging.getLogger('irked')
+
+#
+# Thread owning the database connection.  Rows arrive through a bounded
+# queue; None asks the thread to write what is left and exit.
+#
+class ChannelogWriter(threading.Thread):
+    def __init__(self, path, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_queue=MAX_QUEUE,
+                 retention_days=RETENTION_DAYS):
+        threading.Thread.__init__(self, name='channelog', daemon=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        # when retention next runs, in seconds since the epoch
+        self.next_prune = time.time()
+        self.rows = queue.Queue(max_queue)
+        # backpressure metrics: rows queued, written and dropped, the most
+        # rows ever waiting, transactions committed and the last one's
+        # duration in seconds
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.batches = 0
+        self.errors = 0
+        self.last_flush = 0.0
+        self.pruned = 0
+
+    def put(self, row):
+        '''Queue a row from the event loop, without ever blocking.'''
+        try:
+            self.rows.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("channelog queue full, %d messages dropped",
+                           self.dropped)
+            return
+        self.queued += 1
+        waiting = self.rows.qsize()
+        if waiting > self.high_water:
+            self.high_water = waiting
+
+    def run(self):
+        db = connect(self.path)
+        try:
+            self.prepare(db)
+            running = True
+            while running:
+                batch, running = self.collect()
+                if batch:
+                    self.write(db, batch)
+                if self.retention_days and time.time() >= self.next_prune:
+                    self.prune(db)
+        finally:
+            db.close()
+
+    def prepare(self, db):
+        '''Build the history index and switch an existing database to
+        incremental auto_vacuum.  Both can take a while on a large table,
+        so they run here rather than on the event loop.'''
+        try:
+            with db:
+                db.execute('CREATE INDEX IF NOT EXISTS '
+                           'channelogs_channel_timestamp '
+                           'ON channelogs (channel, timestamp)')
+            if self.retention_days and \
+                    db.execute('PRAGMA auto_vacuum').fetchone()[0] == 0:
+                # the setting only applies to a file created after it, or
+                # once the file is rebuilt
+                logger.info("Rebuilding %s for incremental auto_vacuum",
+                            self.path)
+                db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                db.execute('VACUUM')
+        except sqlite3.Error as err:
+            self.errors += 1
+            logger.error("Unable to prepare channel log %s: %s",
+                         self.path, err)
+
+    def collect(self):
+        '''Wait for a row, then take rows until the batch is full or
+        flush_interval has passed.  Returns the batch and whether to keep
+        running.'''
+        timeout = None
+        if self.retention_days:
+            # wake up for retention even when no one is talking
+            timeout = max(0, self.next_prune - time.time()) + 1
+        try:
+            batch = [self.rows.get(timeout=timeout)]
+        except queue.Empty:
+            return [], True
+        if batch[0] is None:
+            return [], False
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                row = self.rows.get(timeout=max(0, deadline -
+                                                time.monotonic()))
+            except queue.Empty:
+                break
+            if row is None:
+                return batch, False
+            batch.append(row)
+        return batch, True
+
+    def write(self, db, batch):
+        started = time.perf_counter()
+        try:
+            with db:
+                db.executemany('INSERT INTO channelogs '
+                               '(timestamp, channel, nick, message) '
+                               'VALUES (?, ?, ?, ?)', batch)
+        except sqlite3.Error as err:
+            self.errors += 1
+            self.dropped += len(batch)
+            logger.error("Unable to write %d channel messages to %s: %s",
+                         len(batch), self.path, err)
+            return
+        self.last_flush = time.perf_counter() - started
+        self.written += len(batch)
+        self.batches += 1
+
+    def prune(self, db):
+        '''Delete the days that have passed retention_days, oldest first, a
+        day per transaction.  Rows are written in timestamp order, so each
+        day is a range of ids.'''
+        now = time.time()
+        self.next_prune = now - now % DAY + DAY
+        cutoff = (now - now % DAY - self.retention_days * DAY) * 1000
+        try:
+            while True:
+                oldest = db.execute('SELECT timestamp FROM channelogs '
+                                    'ORDER BY id LIMIT 1').fetchone()
+                if oldest is None or oldest[0] >= cutoff:
+                    break
+                day_end = min(oldest[0] - oldest[0] % (DAY * 1000) +
+                              DAY * 1000, cutoff)
+                first_kept = db.execute('SELECT id FROM channelogs '
+                                        'WHERE timestamp >= ? '
+                                        'ORDER BY id LIMIT 1',
+                                        (day_end,)).fetchone()
+                with db:
+                    if first_kept is None:
+                        deleted = db.execute('DELETE FROM channelogs')
+                    else:
+                        deleted = db.execute('DELETE FROM channelogs '
+                                             'WHERE id < ?', first_kept)
+                self.pruned += deleted.rowcount
+            # give the freed pages back, if the database was created with
+            # incremental auto_vacuum
+            db.execute('PRAGMA incremental_vacuum')
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as err:
+            self.errors += 1
+            logger.error("Unable to apply channelog retention to %s: %s",
+                         self.path, err)
+
+    def stop(self, timeout=5):
+        '''Write the rows still queued and wait for the thread to finish,
+        giving up after timeout seconds if it is stuck.'''
+        if not self.is_alive():
+            return
+        try:
+            self.rows.put(None, timeout=timeout)
+        except queue.Full:
+            logger.error("channelog writer is not draining, giving up on "
+                         "%d queued messages", self.rows.qsize())
+            return
+        self.join(timeout)
+
+    def metrics(self):
+        return {
+            'queue' : self.rows.qsize(),
+            'queue_max' : self.rows.maxsize,
+            'queue_high_water' : self.high_water,
+            'queued' : self.queued,
+            'written' : self.written,
+            'dropped' : self.dropped,
+            'batches' : self.batches,
+            'errors' : self.errors,
+            'pruned' : self.pruned,
+            'last_flush_seconds' : self.last_flush,
+        }
+
+def connect(path):
+    db = sqlite3.connect(path)
+    # lets retention shrink the file; only takes effect on a new database,
+    # before it is switched to WAL, see ChannelogWriter.prepare
+    db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    db.execute('PRAGMA journal_mode=WAL')
+    # in WAL mode, only checkpoints need to reach the disk
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
 
 def configure(options):
-    global DB
+    global WRITER, READER, OPTIONS
 
-    DB = sqlite3.connect(options['db'])
-    cur = DB.cursor()
-    cur.execute('CREATE TABLE IF NOT EXISTS channelogs (' \
-                'id integer PRIMARY KEY AUTOINCREMENT,' \
-                'timestamp integer,' \
-                'channel varchar(20),' \
-                'nick varchar(10),' \
-                'message varchar(255))')
+    db = connect(options['db'])
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS channelogs (' \
+                   'id integer PRIMARY KEY AUTOINCREMENT,' \
+                   'timestamp integer,' \
+                   'channel varchar(20),' \
+                   'nick varchar(10),' \
+                   'message varchar(255))')
+    db.close()
+    OPTIONS = {
+        'replay' : int(options.get('replay', REPLAY)),
+        'history_max' : int(options.get('history_max', HISTORY_MAX)),
+    }
+    # history is read from the event loop, alongside the writer
+    READER = connect(options['db'])
+    READER.execute('PRAGMA query_only=ON')
+    WRITER = ChannelogWriter(
+        options['db'],
+        batch_size=int(options.get('batch_size', BATCH_SIZE)),
+        flush_interval=float(options.get('flush_interval', FLUSH_INTERVAL)),
+        max_queue=int(options.get('max_queue', MAX_QUEUE)),
+        retention_days=int(options.get('retention_days', RETENTION_DAYS)))
+    WRITER.start()
 
 # TODO: i really want this to be a post_channel_privmsg
 def pre_channel_privmsg(channel, nick, message):
-    global DB
-    cur = DB.cursor()
-
-    values = (int(time.time() * 1000), channel, nick, message)
-    cur.execute('INSERT INTO channelogs (timestamp, channel, nick, message) ' \
-                'VALUES (?, ?, ?, ?)', values)
-    DB.commit()
+    WRITER.put((int(time.time() * 1000), channel, nick, message))
     return True, message
+
+def channel_history(channel, count=None, start=None, end=None):
+    '''(timestamp in ms, nick, message) of a channel's messages, oldest
+    first: the last count lines (the replay setting if None), or the first
+    lines between start and end, in seconds since the epoch.  Never more
+    than history_max lines.'''
+    if start is not None:
+        end = time.time() if end is None else end
+        return READER.execute('SELECT timestamp, nick, message '
+                              'FROM channelogs '
+                              'WHERE channel = ? AND timestamp BETWEEN ? AND ? '
+                              'ORDER BY timestamp LIMIT ?',
+                              (channel, int(start * 1000), int(end * 1000),
+                               OPTIONS['history_max'])).fetchall()
+    if count is None:
+        count = OPTIONS['replay']
+    count = min(count, OPTIONS['history_max'])
+    if count <= 0:
+        return []
+    rows = READER.execute('SELECT timestamp, nick, message FROM channelogs '
+                          'WHERE channel = ? '
+                          'ORDER BY timestamp DESC LIMIT ?',
+                          (channel, count)).fetchall()
+    rows.reverse()
+    return rows
+
+def metrics():
+    return WRITER.metrics()
+
+def shutdown():
+    WRITER.stop()
+    READER.close()
+    logger.info("channelog wrote %d messages in %d batches, dropped %d",
+                WRITER.written, WRITER.batches, WRITER.dropped)
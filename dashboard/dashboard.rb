@@ -6,7 +6,19 @@ require 'sinatra'
 require 'json'
 require 'sequel'
 
-DB = Sequel.sqlite('dashboard.db')
+# written by irked, see [stats] in irked.conf
+DB = Sequel.sqlite(ENV['IRKED_STATS_DB'] || 'dashboard.db')
+
+# ?resolution= of the graphs, and the table holding it
+RESOLUTIONS = {
+  'raw' => :samples_raw,
+  '1m'  => :samples_1m,
+  '1h'  => :samples_1h,
+  '1d'  => :samples_1d,
+}
+
+# most lines returned by one /channel.log request
+CHANNEL_LOG_MAX = 1000
 
 get '/' do
   redirect '/index.html'
@@ -14,8 +26,8 @@ end
 
 get '/data.json' do
   content_type 'application/json'
-  sent     = transmitted('Sent')
-  received = transmitted('Received')
+  sent     = samples('sent')
+  received = samples('received')
   [
     {label: "sent", data: sent},
     {label: "received", data: received},
@@ -24,20 +36,20 @@ end
 
 get '/messages.json' do
   content_type 'application/json'
-  msg_data = common_query(:messages, :timestamp, :messages).map(&:values)
+  msg_data = samples('messages')
   [{label: 'Messages', data: msg_data}].to_json
 end
 
 get '/users.json' do
   content_type 'application/json'
-  usr_data = common_query(:users, :timestamp, :users).map(&:values)
+  usr_data = samples('users')
   [{label: 'Users', data: usr_data}].to_json
 end
 
 # FIXME: the nodes are real, but the edges are completely made up!
 get '/tree.json' do
   content_type 'application/json'
-  db_json = DB[:servers]
+  db_json = DB[:topology]
     .order_by(:timestamp.desc)
     .limit(1)
     .first[:servers]
@@ -61,8 +73,9 @@ get '/channel.log' do
   end_time   = Integer(params[:end])
   log_entries = DB[:channelogs]
     .where(:channel => params[:channel])
-    .where(:timestamp => params[:start]..params[:end])
+    .where(:timestamp => start_time..end_time)
     .order_by(:timestamp)
+    .limit(CHANNEL_LOG_MAX)
 
   log_entries.inject("") do |log, entry|
     # TODO: include timestamp
@@ -71,16 +84,18 @@ get '/channel.log' do
 end
 
 BEGIN {
-  def common_query(table, *select_cols)
+  # the latest 50 points of a statistic, summed over the server's worker
+  # processes, read through the primary key
+  def samples(statistic)
+    table = RESOLUTIONS.fetch(params[:resolution] || 'raw') {
+      halt 400, 'unknown resolution'
+    }
     DB[table]
-      .select(*select_cols)
+      .select(:timestamp, Sequel.function(:sum, :value))
+      .where(:statistic => statistic)
+      .group(:timestamp)
       .order_by(:timestamp.desc)
       .limit(50)
-  end
-
-  def transmitted(label)
-    common_query(:transmitted, :timestamp, :bytes)
-      .where(:label => label)
       .map(&:values)
   end
 }
@@ -1,4 +1,6 @@
 '''IRC Numeric Message Constants'''
+import re
+
 IRC_MODES = ['a', 's', 'i', 'w', 'o', 'O', 'r' ]
 IRC_USER_MODES = [ 'i', 'w', 'o', 'O', 'r' ]
 IRC_CHANNEL_MODES = ['o', 'p', 's', 'i', 't', 'n', 'b', 'v']
@@ -208,9 +210,12 @@ IRC_CODE = {
     RPL_TRACERECONNECT :
        ("RPL_TRACERECONNECT", ""),
     RPL_STATSLINKINFO :
-       ("RPL_STATSLINKINFO", ""),
+       ("RPL_STATSLINKINFO",
+        "%(link)s %(sendq)d %(sent_messages)d %(sent_kbytes)d "
+        "%(received_messages)d %(received_kbytes)d %(time_open)d"),
     RPL_STATSCOMMANDS :
-       ("RPL_STATSCOMMANDS", ""),
+       ("RPL_STATSCOMMANDS",
+        "%(command)s %(count)d %(bytes)d %(remote)d %(p50)d %(p99)d"),
     RPL_STATSCLINE :
        ("RPL_STATSCLINE", ""),
     RPL_STATSNLINE :
@@ -312,7 +317,7 @@ IRC_CODE = {
     RPL_ENDOFWHOIS :
        ("RPL_ENDOFWHOIS", ":End of WHOIS list"),
     RPL_WHOISCHANNELS :
-       ("RPL_WHOISCHANNELS", ""),
+       ("RPL_WHOISCHANNELS", "%(nick)s :%(channels)s"),
     RPL_LISTSTART :
        ("RPL_LISTSTART", ""),
     RPL_LIST :
@@ -336,7 +341,7 @@ IRC_CODE = {
        ("RPL_INVITELIST", "%(channel)s %(mask)s"),
     RPL_ENDOFINVITELIST :
        ("RPL_ENDOFINVITELIST", 
-        "%s :End of channel invite list"),
+        "%(channel)s :End of channel invite list"),
     RPL_EXCEPTLIST :
        ("RPL_EXCEPTLIST", "%(channel)s %(mask)s"),
     RPL_ENDOFEXCEPTLIST :
@@ -384,7 +389,7 @@ IRC_CODE = {
     RPL_YOUREOPER :
        ("RPL_YOUREOPER", ':You are now an IRC operator'),
     RPL_REHASHING :
-       ("RPL_REHASHING", ""),
+       ("RPL_REHASHING", "%(config_file)s :Rehashing"),
     RPL_YOURESERVICE :
        ("RPL_YOURESERVICE", ""),
     RPL_MYPORTIS :
@@ -430,7 +435,7 @@ IRC_CODE = {
     ERR_BADMASK :
        ("ERR_BADMASK", ""),
     ERR_UNKNOWNCOMMAND :
-       ("ERR_UNKNOWNCOMMAND", ""),
+       ("ERR_UNKNOWNCOMMAND", "%(command)s :Unknown command"),
     ERR_NOMOTD :
        ("ERR_NOMOTD", ":MOTD File is missing"),
     ERR_NOADMININFO :
@@ -440,19 +445,20 @@ IRC_CODE = {
     ERR_NONICKNAMEGIVEN :
        ("ERR_NONICKNAMEGIVEN", ':No nickname given'),
     ERR_ERRONEUSNICKNAME :
-       ("ERR_ERRONEUSNICKNAME", ""),
+       ("ERR_ERRONEUSNICKNAME", '%(nickname)s :Erroneous nickname'),
     ERR_NICKNAMEINUSE :
        ("ERR_NICKNAMEINUSE", '%(nickname)s :Nickname is already in use'),
     ERR_NICKCOLLISION :
        ("ERR_NICKCOLLISION", ""),
     ERR_UNAVAILRESOURCE :
-       ("ERR_UNAVAILRESOURCE", ""),
+       ("ERR_UNAVAILRESOURCE",
+        "%(name)s :Nick/channel is temporarily unavailable"),
     ERR_USERNOTINCHANNEL :
        ("ERR_USERNOTINCHANNEL",
         "%(nickname)s %(channel)s :They aren't on that channel"),
     ERR_NOTONCHANNEL :
        ("ERR_NOTONCHANNEL",
-        "%{channel_name}s :You're not on that channel"),
+        "%(channel)s :You're not on that channel"),
     ERR_USERONCHANNEL :
        ("ERR_USERONCHANNEL",
         '%(nickname)s %(channel)s :is already on channel'),
@@ -463,7 +469,7 @@ IRC_CODE = {
     ERR_USERSDISABLED :
        ("ERR_USERSDISABLED", ""),
     ERR_NOTREGISTERED :
-       ("ERR_NOTREGISTERED", ""),
+       ("ERR_NOTREGISTERED", ":You have not registered"),
     ERR_NEEDMOREPARAMS :
        ("ERR_NEEDMOREPARAMS", 
         "%(command)s :Not enough parameters"),
@@ -531,9 +537,52 @@ IRC_CODE = {
 
 CHANNEL_PREFIX = ['&', '#', '+', '!']
 
+# RFC 2812 message size limit, including the trailing CR-LF
+MAX_LINE = 512
+# longest nick accepted, which replies shared between clients are sized for
+NICKLEN = 30
+# RFC 2812 2.3.1: a letter or special, then letters, digits, specials or '-'
+_NICK = re.compile(r'[A-Za-z\[-`{-}][-0-9A-Za-z\[-`{-}]*\Z')
+
 def is_channel_name(name):
     return len(name[1:]) < 200 and name[0] in CHANNEL_PREFIX
 
+def is_valid_nick(nick):
+    return len(nick) <= NICKLEN and _NICK.match(nick) is not None
+
+# RFC 2812 2.2: {}|^ are the lower case equivalents of []\~
+_IRC_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~',
+                           'abcdefghijklmnopqrstuvwxyz{}|^')
+
+def irc_lower(name):
+    '''Case fold a nick or channel name for comparison.'''
+    return name.translate(_IRC_LOWER)
+
+#
+# dict keyed by nick or channel name, case folded with irc_lower() so that
+# "Erin" and "erin" are the same key.  Keys are stored folded.
+#
+class IrcDict(dict):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, irc_lower(key))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, irc_lower(key), value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, irc_lower(key))
+
+    def __contains__(self, key):
+        return dict.__contains__(self, irc_lower(key))
+
+    def get(self, key, default=None):
+        return dict.get(self, irc_lower(key), default)
+
+    def pop(self, key, *default):
+        return dict.pop(self, irc_lower(key), *default)
+
 def mode_str(modes):
     '''Return a  concatenated string of active mode flags.
     Input is a dictionary of single char flag IDs to boolean.'''
@@ -1,17 +1,126 @@
+import time
 import irc
 from irc.channel_mode import ChannelMode
 
+#
+# A channel member and its status flags
+#
+class Member:
+    __slots__ = ('client', 'op', 'voice')
+
+    def __init__(self, client, op=False, voice=False):
+        self.client = client
+        self.op = op
+        self.voice = voice
+
+    def prefix(self):
+        if self.op:
+            return '@'
+        if self.voice:
+            return '+'
+        return ''
+
+    def name(self):
+        return self.prefix() + self.client.nick()
+
+#
+# The rendered NAMES list of a channel, split into RPL_NAMREPLY sized lines.
+#
+# Members are packed into chunks of at most `budget` bytes.  A join appends to
+# the last chunk, a part removes from the member's chunk, and only chunks that
+# changed are joined into a string again, so answering NAMES costs one cached
+# string per line instead of rebuilding the list for every join.
+#
+class NamesChunk:
+    __slots__ = ('names', 'size', 'rendered')
+
+    def __init__(self):
+        # Member -> rendered name, in join order
+        self.names = dict()
+        self.size = 0
+        self.rendered = None
+
+class NamesCache:
+    def __init__(self, budget):
+        self.budget = budget
+        self.chunks = []
+        # Member -> the NamesChunk holding it
+        self.where = dict()
+
+    def add(self, member):
+        if member in self.where:
+            self.remove(member)
+        name = member.name()
+        cost = len(name.encode()) + 1
+        if not self.chunks or self.chunks[-1].size + cost > self.budget:
+            self.chunks.append(NamesChunk())
+        chunk = self.chunks[-1]
+        chunk.names[member] = name
+        chunk.size += cost
+        chunk.rendered = None
+        self.where[member] = chunk
+
+    def remove(self, member):
+        chunk = self.where.pop(member, None)
+        if chunk is None:
+            return
+        name = chunk.names.pop(member)
+        chunk.size -= len(name.encode()) + 1
+        chunk.rendered = None
+        if not chunk.names:
+            self.chunks.remove(chunk)
+
+    def update(self, member):
+        '''Re-render a member whose nick or status changed.'''
+        chunk = self.where.get(member)
+        if chunk is None:
+            return
+        name = member.name()
+        size = chunk.size + len(name.encode()) - \
+            len(chunk.names[member].encode())
+        if size > self.budget:
+            self.remove(member)
+            self.add(member)
+            return
+        chunk.names[member] = name
+        chunk.size = size
+        chunk.rendered = None
+
+    def lines(self):
+        for chunk in self.chunks:
+            if chunk.rendered is None:
+                chunk.rendered = ' '.join(chunk.names.values())
+            yield chunk.rendered
+
 class Channel:
     def __init__(self, name, server):
         self.name    = name
+        # every member client, for fan-out and membership tests
         self.clients = set()
+        # case folded nick -> Member
+        self.members = dict()
         self.topic   = None
 
         self.modes = ChannelMode()
         self.server  = server
 
+        # room left for names in ":<server> 353 <nick> = <channel> :...\r\n"
+        header = ':%s %03d %s = %s :' % (server.name, irc.RPL_NAMREPLY,
+                                         'x' * irc.NICKLEN, name)
+        self.names = NamesCache(irc.MAX_LINE - 2 - len(header.encode()))
+
     def add(self, client):
+        '''Join client to the channel.  Returns False, changing nothing, if
+        it is already a member.'''
+        if client in self.clients:
+            return False
+        # whoever creates the channel by joining it gets ops
+        op = not self.clients
+        member = Member(client, op)
         self.clients.add(client)
+        self.members[irc.irc_lower(client.nick())] = member
+        self.names.add(member)
+        client.channels.add(self)
         self._send(client, 'JOIN %s' % self.name)
 
         if self.topic:
@@ -20,6 +129,7 @@ class Channel:
                                     topic=self.topic)
 
         self.rpl_name_reply(client)
+        return True
 
     def remove(self, client, message = None, parted = True):
         if client in self.clients:
@@ -29,6 +139,10 @@ class Channel:
                 else:
                     self._send(client, 'PART %s' % self.name)
             self.clients.remove(client)
+            member = self.members.pop(irc.irc_lower(client.nick()), None)
+            if member is not None:
+                self.names.remove(member)
+            client.channels.discard(self)
 
             # FIXME: we should have a proper interface for adding/removing
             # channels
@@ -37,6 +151,38 @@ class Channel:
         else:
             client.connection.reply(irc.ERR_NOTONCHANNEL, channel=self.name)
 
+    def member(self, nick):
+        '''Returns the Member with the given nick, or None.'''
+        return self.members.get(irc.irc_lower(nick))
+
+    def is_op(self, client):
+        member = self.members.get(irc.irc_lower(client.nick()))
+        return member is not None and member.client is client and member.op
+
+    def rename(self, old_nick, new_nick):
+        member = self.members.pop(irc.irc_lower(old_nick), None)
+        if member is not None:
+            self.members[irc.irc_lower(new_nick)] = member
+            self.names.update(member)
+
+    def set_member_mode(self, setter, mode, enable, nick):
+        '''Give or take a member status (op or voice).  Returns True if the
+        member's status changed.'''
+        if not self.is_op(setter):
+            setter.connection.reply(irc.ERR_CHANOPRIVSNEEDED, channel=self.name)
+            return
+        member = self.member(nick)
+        if member is None:
+            setter.connection.reply(irc.ERR_USERNOTINCHANNEL,
+                                    nickname=nick, channel=self.name)
+            return
+        flag = self.modes.member_modes[mode]
+        if getattr(member, flag) == enable:
+            return
+        setattr(member, flag, enable)
+        self.names.update(member)
+        return True
+
     def privmsg(self, sender, message):
         if self.modes.insiders_only() and sender not in self.clients:
             sender.connection.reply(irc.ERR_CANNOTSENDTOCHAN, channel=self.name)
@@ -58,15 +204,15 @@ class Channel:
         # TODO: kickee probably can be more than just a nick
 
         if kicker not in self.clients:
-            kicker.connection.reply(irc.ERR_NOTONCHANNEL,
-                                    channel_name=self.name)
+            kicker.connection.reply(irc.ERR_NOTONCHANNEL, channel=self.name)
             return
 
-        if kicker not in self.modes.operators:
+        if not self.is_op(kicker):
             kicker.connection.reply(irc.ERR_CHANOPRIVSNEEDED, channel=self.name)
             return
 
-        if kickee not in [c.nick() for c in self.clients]:
+        member = self.member(kickee)
+        if member is None:
             kicker.connection.reply(irc.ERR_USERNOTINCHANNEL,
                                     nickname=kickee, channel=self.name)
             return
@@ -75,23 +221,14 @@ class Channel:
             reason = kickee
 
         self._send(kicker, "KICK %s %s :%s" % (self.name, kickee, reason))
-
-        # TODO: i really don't want to iterate over all the clients here, make
-        # clients a hash
-        kickee_client = None
-        for c in self.clients:
-            if c.nick() == kickee:
-                kickee_client = c
-                break
-        self.remove(kickee_client, message = None, parted = False)
+        self.remove(member.client, message = None, parted = False)
 
     def set_topic(self, client, topic):
         if client not in self.clients:
-            client.connection.reply(irc.ERR_NOTONCHANNEL,
-                                    channel_name=self.name)
+            client.connection.reply(irc.ERR_NOTONCHANNEL, channel=self.name)
             return
 
-        if self.modes.set_topic_needs_ops() and not self.modes.is_op(client):
+        if self.modes.set_topic_needs_ops() and not self.is_op(client):
             client.connection.reply(irc.ERR_CHANOPRIVSNEEDED,
                                   channel=self.name)
             return
@@ -116,29 +253,41 @@ class Channel:
                                     channel=self.name)
 
     def rpl_name_reply(self, client):
-        names = [c.nick() for c in self.clients]
-        names = []
-        for c in self.clients:
-            prefix = ''
-            if c in self.modes.operators:
-                prefix = '@'
-            names.append(prefix + c.nick())
-
-        # TODO: need to split the names list up in case it's too long
         if client.connection:
-            client.connection.reply(irc.RPL_NAMREPLY,
-                                    channel=self.name, nick=str.join(' ', names))
-            client.connection.reply(irc.RPL_ENDOFNAMES, channel=self.name)
+            replies = [(irc.RPL_NAMREPLY, dict(channel=self.name, nick=names))
+                       for names in self.names.lines()]
+            replies.append((irc.RPL_ENDOFNAMES, dict(channel=self.name)))
+            client.connection.replies(replies)
 
     def rpl_who(self, client):
-        for c in self.clients:
-            if not client.connection:
-                continue
-            client.connection.reply(irc.RPL_WHOREPLY,
-                    channel=self.name, user=c.username(),
-                    host=c.host(), server=self.server.name,
-                    nick=c.nick(), foo1="*", foo2="", hopcount=0,
-                    realname=c.realname())
+        if not client.connection:
+            return
+        client.connection.replies(
+            (irc.RPL_WHOREPLY, dict(channel=self.name, user=c.username(),
+                                    host=c.host(), server=self.server.name,
+                                    nick=c.nick(), foo1="*", foo2="",
+                                    hopcount=0, realname=c.realname()))
+            for c in self.clients)
+
+    def replay_history(self, client, count=None, start=None, end=None):
+        '''Send client the channel's logged messages as NOTICEs from the
+        server, see IrcExtensions.channel_history.  Returns False if no
+        extension keeps history.'''
+        lines = self.server.extensions.channel_history(self.name, count,
+                                                       start, end)
+        if lines is None:
+            return False
+        if not lines or not client.connection:
+            return True
+        prefix = self.server.prefix()
+        client.connection.raw_send(''.join(
+            '%s NOTICE %s :[%s] <%s> %s\r\n' %
+            (prefix, self.name,
+             time.strftime('%Y-%m-%d %H:%M:%S',
+                           time.localtime(timestamp / 1000)),
+             nick, message)
+            for timestamp, nick, message in lines))
+        return True
 
     def _send(self, sender, message, notify_sender = True):
         self.server.notify_channel(self.name, sender, message, notify_sender)
@@ -1,27 +1,30 @@
 class ChannelMode:
     def __init__(self):
-        self.operators = set()
+        self.creator = None
 
         # available_modes don't get reported in the mode string (it should be
         # possible to query them individually however)
         # TODO: load defaults from config file
         self.modes = {'n': True, 't': True}
-        self.available_modes = set({'n', 'o', 't'})
+        self.available_modes = set({'n', 'o', 't', 'v'})
+
+    # modes that change the status of a member rather than the channel
+    member_modes = {'o': 'op', 'v': 'voice'}
 
     def mode_string(self):
         enabled_flags = [flag for flag, is_on in self.modes.items() if is_on]
         enabled_flags.sort()
         return '+' + str.join('', enabled_flags)
 
-    def is_op(self, client):
-        return client in self.operators
-
     def set_topic_needs_ops(self):
         return self.modes['t']
 
     def insiders_only(self):
         return self.modes['n']
 
+    def invite_only(self):
+        return self.modes.get('i', False)
+
     def set(self, mode, enable, params = None):
         """ sets the given mode
 
@@ -34,8 +37,8 @@ class ChannelMode:
         if mode not in self.available_modes:
             return
 
-        if mode == 'o':
-            # TODO: op removal
+        if mode in self.member_modes:
+            # see Channel.set_member_mode
             return
 
         if enable:
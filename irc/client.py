@@ -4,38 +4,46 @@ import time
 import irc
 import socket as _socket
 from irc.message import IrcClientMessageMixin
+from irc.commands import command, dispatch_table
+
+# connections listed by STATS q
+STATS_SENDQ_COUNT = 10
 
 #
 # IrcClient handles commands and data for IRC client connections
 #
+@dispatch_table
 class IrcClient(IrcClientMessageMixin):
     def __init__(self, connection, server):
         self.server = server
         self.connection = connection
+        # channels this client is a member of, maintained by Channel
+        self.channels = set()
+        # cached ":nick!user@host", see prefix()
+        self._prefix = None
+        self._prefix_bytes = None
+        # set once cmd_quit has cleaned up after the client
+        self.quit_done = False
         self.modes = dict()
         for i in irc.IRC_MODES:
             self.modes[i] = False
 
         self.cmd_motd(list())
 
+    @command()
     def cmd_motd(self, args):
         #TODO Need to fetch motd from other servers.
-        if (not self.server.has_motd()):
+        motd = self.server.motd_block()
+        if motd is None:
             self.connection.reply(irc.ERR_NOMOTD)
             return
-        self.connection.reply(irc.RPL_MOTDSTART, server=self.server.name)
-        for line in self.server.motd():
-            self.connection.reply(irc.RPL_MOTD, motd_line=line)
-        self.connection.reply(irc.RPL_ENDOFMOTD)
+        self.connection.reply_block(motd)
 
+    @command(min_params=1)
     def cmd_join(self, args):
         # TODO: support keys
-        if len(args) == 0:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='JOIN')
-            return
-
         if args[0] == "0":
-            for channel in self.server.channels.values():
+            for channel in list(self.channels):
                 channel.remove(self)
             return
 
@@ -43,36 +51,79 @@ class IrcClient(IrcClientMessageMixin):
         for channel in channels:
             if channel not in self.server.channels:
                 self.server.channel_add(channel, self)
-            self.server.channels[channel].add(self)
+            if self.server.channels[channel].add(self):
+                self.server.channels[channel].replay_history(self)
 
+    @command(min_params=1)
     def cmd_part(self, args):
-        if len(args) == 0:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='PART')
-            return
-
         channels = re.split(",", args[0])
 
         part_message = None
         if len(args) == 2:
             part_message = args[1]
 
-        for channel in channels:
-            self.server.channels[channel].remove(self, part_message)
+        for name in channels:
+            channel = self.server.channels.get(name)
+            if channel is None:
+                self.connection.reply(irc.ERR_NOSUCHCHANNEL, channel=name)
+            else:
+                channel.remove(self, part_message)
+
+    @command(min_params=1)
+    def cmd_history(self, args):
+        '''HISTORY <channel> [<count> | <start> <end>], start and end in
+        seconds since the epoch.'''
+        channel = self.server.channels.get(args[0])
+        if channel is None:
+            self.connection.reply(irc.ERR_NOSUCHCHANNEL, channel=args[0])
+            return
+        if self not in channel.clients:
+            self.connection.reply(irc.ERR_NOTONCHANNEL, channel=args[0])
+            return
+        count = start = end = None
+        try:
+            if len(args) == 2:
+                count = int(args[1])
+            elif len(args) > 2:
+                start, end = int(args[1]), int(args[2])
+        except ValueError:
+            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='HISTORY')
+            return
+        if not channel.replay_history(self, count, start, end):
+            self.connection.reply(irc.ERR_UNKNOWNCOMMAND, command='HISTORY')
 
+    @command()
+    def cmd_names(self, args):
+        # TODO: server target, and listing every visible channel
+        if not len(args):
+            self.connection.reply(irc.RPL_ENDOFNAMES, channel='*')
+            return
+        for name in re.split(",", args[0]):
+            channel = self.server.channels.get(name)
+            if channel is None:
+                self.connection.reply(irc.RPL_ENDOFNAMES, channel=name)
+            else:
+                channel.rpl_name_reply(self)
+
+    @command()
     def cmd_time(self, args):
         # TODO: multi-server stuff
         self.connection.reply(irc.RPL_TIME,
                               server=self.server.name,
                               time=time.asctime(time.localtime()))
 
+    @command()
     def cmd_quit(self, args):
         # TODO: don't allow netsplit-style QUIT messages (2813#4.1.5)
+        # the connection may be lost while a QUIT is already under way, or
+        # while a pending drop (sendq, flood) is still to run
+        if self.quit_done:
+            return
+        self.quit_done = True
         to_notify = set({self})
-        to_leave = set()
-        for channel in self.server.channels.values():
-            if self in channel.clients:
-                to_leave.add(channel)
-                to_notify |= channel.clients
+        to_leave = set(self.channels)
+        for channel in to_leave:
+            to_notify |= channel.clients
 
         if len(args):
             message = '%s QUIT :%s\r\n' % (self.prefix(), args[0])
@@ -82,44 +133,40 @@ class IrcClient(IrcClientMessageMixin):
             message = '%s QUIT\r\n' % self.prefix()
             err_msg = 'ERROR :Closing Link: %s\r\n' % self.prefix()
 
+        data = message.encode()
         for client in to_notify:
-            client.connection.raw_send(message)
+            client.connection.queue(data)
 
         for channel in to_leave:
             channel.remove(self, parted = False)
 
-        self.server.connections.remove(self.connection)
-        del self.server.clients[self.connection.nick]
+        self.server.connections.discard(self.connection)
+        self.server.clients.pop(self.connection.nick, None)
 
         # send error message (see RFC)
         self.connection.raw_send(err_msg)
-        self.connection.close()
+        self.connection.close_when_done()
 
         for server in self.server.servers.values():
             server.connection.raw_send(message)
 
+    @command(min_params=2)
     def cmd_squit(self, args):
         if not self.modes['o']:
             self.connection.reply(irc.ERR_NOPRIVILEGES)
-        if len(args) != 2:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='SQUIT')
             return
-        target_server, comment = args
+        target_server, comment = args[:2]
         if not target_server in self.server.servers:
             self.connection.reply(irc.ERR_NOSUCHSERVER, server=target_server)
             return
         self.server.squit(target_server, comment)
 
+    @command(min_params=2)
     def cmd_connect(self, args):
         if not self.modes['o']:
             self.connection.reply(irc.ERR_NOPRIVILEGES)
-        if len(args) == 2:
-            server, port = args
-        elif len(args) == 3:
-            server, port, remote = args
-        else:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='CONNECT')
             return
+        server, port = args[:2]
         try:
             #TODO remote connect
             self.server.sconnect(server, int(port))
@@ -127,10 +174,9 @@ class IrcClient(IrcClientMessageMixin):
             self.server.logger.error("Error connecting to server: %s", err)
             self.connection.reply(irc.ERR_NOSUCHSERVER, server=server)
 
+    @command(min_params=1)
     def cmd_topic(self, args):
         self.server.logger.debug("TOPIC args: %s", args)
-        if len(args) == 0:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='TOPIC')
         channel_name = args[0]
 
         if channel_name not in self.server.channels:
@@ -146,6 +192,7 @@ class IrcClient(IrcClientMessageMixin):
         else:
             channel.rpl_topic(self)
 
+    @command()
     def cmd_list(self, args):
         # TODO: server target
 
@@ -157,23 +204,20 @@ class IrcClient(IrcClientMessageMixin):
         else:
             channels = self.server.channels.values()
 
-        for channel in channels:
-            # need to check visibility here
-            self.connection.reply(irc.RPL_LIST,
-                                  channel=channel.name,
-                                  visible=len(channel.clients),
-                                  topic=channel.topic or "")
-        self.connection.reply(irc.RPL_LISTEND)
+        # need to check visibility here
+        replies = [(irc.RPL_LIST, dict(channel=channel.name,
+                                       visible=len(channel.clients),
+                                       topic=channel.topic or ""))
+                   for channel in channels]
+        replies.append((irc.RPL_LISTEND, None))
+        self.connection.replies(replies)
 
+    @command(min_params=2)
     def cmd_kick(self, args):
         """ KICK command, rfc2812 3.2.8 """
 
         # TODO: channel can be a chanmask
 
-        if len(args) < 2:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command="KICK")
-            return
-
         chan_list, user_list = args[0:2]
 
         channels = re.split(",", chan_list)
@@ -200,6 +244,7 @@ class IrcClient(IrcClientMessageMixin):
         else:
             pass # TODO
 
+    @command()
     def cmd_privmsg(self, args):
         if len(args) == 0:
             self.connection.reply(irc.ERR_NORECIPIENT, command='JOIN')
@@ -226,15 +271,13 @@ class IrcClient(IrcClientMessageMixin):
             recipient.connection.raw_send('%s PRIVMSG %s :%s\r\n' %
                     (self.prefix(), recipient.connection.nick, text))
 
+    @command(min_params=1)
     def cmd_whois(self, args):
         # TODO: support server target
 
         target = None
         mask_list = None
 
-        if len(args) == 0:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='WHOIS')
-            return
         if len(args) > 1:
             target = args[0]
             mask_list = args[1]
@@ -253,23 +296,18 @@ class IrcClient(IrcClientMessageMixin):
             client = self.server.clients[mask]
             client.rpl_whoami(requester=self)
 
+    @command(min_params=1)
     def cmd_ping(self, args):
         # TODO: multi-server stuff
-        if not len(args):
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='PING')
-            return
         target = args[0]
 
         self.connection.raw_send("%s PONG :%s\r\n" %
                                  (self.server.prefix(), target))
 
+    @command(min_params=1)
     def cmd_who(self, args):
         # TODO: who can take a mask, but we're just supporting channels for now
         # (pidgin needs this to join a channel)
-        if not len(args):
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='WHO')
-            return
-
         channel = args[0] # TODO
         ops_only = False  # TODO
         if len(args) > 1 and args[1] == "o":
@@ -280,14 +318,13 @@ class IrcClient(IrcClientMessageMixin):
             self.server.channels[channel].rpl_who(self)
         self.connection.reply(irc.RPL_ENDOFWHO)
 
+    @command()
     def cmd_away(self, args):
         # not implementing this for now (it's an optional feature)
         self.connection.reply(irc.RPL_UNAWAY)
 
+    @command(min_params=1)
     def cmd_mode(self, args):
-        if not len(args) > 0:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='MODE')
-            return
         target = args[0]
         if irc.is_channel_name(target):
             self.cmd_chan_mode(target, args[1:])
@@ -330,17 +367,23 @@ class IrcClient(IrcClientMessageMixin):
             return
 
         op, mode, params = match.groups()
+        if not params and len(args) > 1:
+            params = args[1]
         to_add = op == '+'
-        mode_changed = channel.modes.set(mode, to_add, params)
+        if mode in channel.modes.member_modes:
+            if not params:
+                self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='MODE')
+                return
+            mode_changed = channel.set_member_mode(self, mode, to_add, params)
+        else:
+            mode_changed = channel.modes.set(mode, to_add, params)
         if mode_changed:
             channel._send(self,
                     'MODE %s %s%s %s' % (target, op, mode, params))
 
+    @command(min_params=2)
     def cmd_oper(self, args):
-        if len(args) != 2:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='OPER')
-            return
-        username, password = args
+        username, password = args[:2]
         if not self.server.allows_oper():
             self.connection.reply(irc.ERR_NOOPERHOST)
             return
@@ -352,12 +395,19 @@ class IrcClient(IrcClientMessageMixin):
         self.connection.reply(irc.RPL_UMODEIS, mode=irc.mode_str(self.modes))
 
 
+    @command()
+    def cmd_rehash(self, args):
+        if not self.is_op():
+            self.connection.reply(irc.ERR_NOPRIVILEGES)
+            return
+        self.connection.reply(irc.RPL_REHASHING,
+                              config_file=self.server.config_file)
+        self.server.rehash()
+
+    @command(min_params=2)
     def cmd_invite(self, args):
         '''Implements RCF 2812 Section 3.2.7 and RFC 1459 Section 4.2.7'''
-        if len(args) != 2:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='INVITE')
-            return
-        nickname, channel_name = args
+        nickname, channel_name = args[:2]
         if nickname not in self.server.clients:
             self.connection.reply(irc.ERR_NOSUCHNICK, nickname=nickname)
             return
@@ -367,13 +417,13 @@ class IrcClient(IrcClientMessageMixin):
             channel = self.server.channels[channel_name]
             if self not in channel.clients:
                 self.connection.reply(irc.ERR_NOTONCHANNEL,
-                                      channel_name=channel_name)
+                                      channel=channel_name)
                 return
             elif target in channel.clients:
                 self.connection.reply(irc.ERR_USERONCHANNEL,
                                       nickname=nickname, channel=channel_name)
                 return
-            elif channel.modes.invite and self not in channel.modes.operators:
+            elif channel.modes.invite_only() and not channel.is_op(self):
                 self.connection.reply(irc.ERR_CHANOPRIVSNEEDED,
                                       channel=channel_name)
                 return
@@ -384,6 +434,7 @@ class IrcClient(IrcClientMessageMixin):
                                 nickname=nickname,
                                 channel=channel_name)
 
+    @command()
     def cmd_lusers(self, args):
         '''Implements RFC 2812 Section 3.4.2'''
         users = len(self.server.clients)
@@ -416,6 +467,7 @@ class IrcClient(IrcClientMessageMixin):
                 self.server.logger.debug("%s --> %s hop %d",
                                          server_name, neighbor_name, neighbor.hopcount)
 
+    @command()
     def cmd_version(self, args):
         if len(args) > 0:
             #TODO Multi server info
@@ -432,20 +484,16 @@ class IrcClient(IrcClientMessageMixin):
                               server=server,
                               comment=comment)
 
+    @command()
     def cmd_info(self, args):
         if len(args) > 0:
             server_name = args[0]
             self.connection.reply(irc.ERR_NOSUCHSERVER, server=server_name)
-        for info in self.server.info():
-            self.connection.reply(irc.RPL_INFO, info=info)
-        self.connection.reply(irc.RPL_ENDOFINFO)
+        self.connection.reply_block(self.server.info_block())
 
+    @command(min_params=1)
     def cmd_stats(self, args):
-        if len(args) == 0:
-            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command='STATS')
-            return
-        if len(args) > 0:
-            stat_type = args[0]
+        stat_type = args[0]
         target = None
         if len(args) > 1:
             target = args[1]
@@ -457,8 +505,40 @@ class IrcClient(IrcClientMessageMixin):
         if stat_type.lower() == 'm':
             self.connection.reply(irc.RPL_STATSSENT, server=self.server.name,
                                   data=self.server.statistics.messages)
+            self.rpl_stats_commands()
+        if stat_type.lower() == 'q':
+            if not self.is_op():
+                self.connection.reply(irc.ERR_NOPRIVILEGES)
+            else:
+                self.rpl_stats_sendq()
         self.connection.reply(irc.RPL_ENDOFSTATS, stat_query=stat_type)
 
+    def rpl_stats_commands(self):
+        '''Command usage, most time spent first.  Beyond RFC 2812's count,
+        bytes and remote count, each line has the median and 99th
+        percentile time taken, in microseconds.'''
+        self.connection.replies(
+            (irc.RPL_STATSCOMMANDS,
+             dict(command=command, count=entry.count, bytes=entry.bytes,
+                  remote=entry.remote, p50=entry.percentile(0.5) // 1000,
+                  p99=entry.percentile(0.99) // 1000))
+            for command, entry in self.server.statistics.commands.busiest())
+
+    def rpl_stats_sendq(self):
+        '''Connections with the most output waiting, largest first.'''
+        now = time.monotonic()
+        self.connection.replies(
+            (irc.RPL_STATSLINKINFO,
+             dict(link='%s[%s]' % (connection.nick or '*', connection.host),
+                  sendq=connection.out_size,
+                  sent_messages=connection.sent_messages,
+                  sent_kbytes=connection.sent_bytes // 1024,
+                  received_messages=connection.received_messages,
+                  received_kbytes=connection.received_bytes // 1024,
+                  time_open=now - connection.connected))
+            for connection in self.server.sendq_consumers(STATS_SENDQ_COUNT))
+
+    @command()
     def cmd_links(self, args):
         if len(args) > 0:
             self.connection.reply(irc.ERR_NOSUCHSERVER, args[0])
@@ -486,18 +566,19 @@ class IrcClient(IrcClientMessageMixin):
                                       server_info=neighbor.info)
         self.connection.reply(irc.RPL_ENDOFLINKS, mask=local_fqdn)
 
+    @command()
     def cmd_trace(self, args):
         pass
 
     def cmd(self, prefix, command, args):
-        try:
-            cmd = getattr(self, 'cmd_%s' % command.lower())
-        except AttributeError as err:
-            self.server.logger.warning("Unimplemented command %s with args %s",
-                                       command,
-                                       args)
+        entry = self.COMMANDS.get(command)
+        if entry is None:
+            self.connection.unknown_command(command)
+            return
+        if len(args) < entry.min_params:
+            self.connection.reply(irc.ERR_NEEDMOREPARAMS, command=command)
             return
-        cmd(args)
+        entry.handler(self, args)
 
     def nick(self):
         return self.connection.nick
@@ -506,7 +587,7 @@ class IrcClient(IrcClientMessageMixin):
         return self.connection.user[0]
 
     def host(self):
-        return self.connection._host()
+        return self.connection.hostname
 
     def realname(self):
         return self.connection.user[2]
@@ -518,7 +599,21 @@ class IrcClient(IrcClientMessageMixin):
         return self.server.token
 
     def prefix(self):
-        return ":%s!%s@%s" % (self.nick(), self.username(), self.host())
+        if self._prefix is None:
+            self._prefix = ":%s!%s@%s" % (self.nick(), self.username(),
+                                          self.host())
+            self._prefix_bytes = self._prefix.encode()
+        return self._prefix
+
+    def prefix_bytes(self):
+        '''The prefix, encoded, for building messages as bytes.'''
+        if self._prefix is None:
+            self.prefix()
+        return self._prefix_bytes
+
+    def invalidate_prefix(self):
+        '''Forget the cached prefix, after a nick or host change.'''
+        self._prefix = None
 
     def is_op(self):
         return self.modes['o']
@@ -528,8 +623,20 @@ class IrcClient(IrcClientMessageMixin):
                 nick=self.nick(), user=self.username(), host=self.host(),
                 realname=self.realname())
         # TODO: irc.RPL_WHOISOPERATOR
-        # TODO: irc.RPL_WHOISCHANNELS
+        if self.channels:
+            requester.connection.reply(irc.RPL_WHOISCHANNELS,
+                    nick=self.nick(), channels=whois_channels(self))
         # TODO: irc.RPL_WHOISSERVER
         # TODO: irc.RPL_AWAY
         # TODO: irc.RPL_WHOISIDLE
         requester.connection.reply(irc.RPL_ENDOFWHOIS)
+
+def whois_channels(client):
+    '''Space separated list of client's channels for RPL_WHOISCHANNELS.'''
+    names = []
+    for channel in client.channels:
+        if channel.is_op(client):
+            names.append('@' + channel.name)
+        else:
+            names.append(channel.name)
+    return ' '.join(names)
@@ -0,0 +1,43 @@
+'''Command dispatch tables.
+
+Command handlers are declared with the @command decorator, which records the
+minimum number of parameters the command needs and when it may be used.
+@dispatch_table then collects a class's handlers once, at import time, into a
+COMMANDS dictionary keyed by upper case command name:
+
+    @dispatch_table
+    class IrcClient:
+        @command(min_params=1)
+        def cmd_join(self, args):
+            ...
+'''
+from collections import namedtuple
+
+# registration state a command may be used in
+ANY = None
+UNREGISTERED = False
+REGISTERED = True
+
+Command = namedtuple('Command', 'name handler min_params registered')
+
+def command(name=None, min_params=0, registered=REGISTERED):
+    '''Declare a cmd_<name> method as the handler of an IRC command.'''
+    def decorate(function):
+        command_name = name or function.__name__[len('cmd_'):].upper()
+        function.irc_command = (command_name, min_params, registered)
+        return function
+    return decorate
+
+def dispatch_table(cls):
+    '''Class decorator building cls.COMMANDS from the @command methods of the
+    class and its bases.'''
+    table = dict()
+    for klass in reversed(cls.__mro__):
+        for attribute in vars(klass).values():
+            spec = getattr(attribute, 'irc_command', None)
+            if spec is None:
+                continue
+            name, min_params, registered = spec
+            table[name] = Command(name, attribute, min_params, registered)
+    cls.COMMANDS = table
+    return cls
@@ -1,7 +1,11 @@
+import sys
+
 HANDLER_LIST = [
     'transform_privmsg',
     'pre_channel_create',
     'pre_channel_privmsg',
+    'channel_history',
+    'shutdown',
 ]
 
 class IrcExtensions:
@@ -51,3 +55,26 @@ class IrcExtensions:
             if not success:
                 return (success, message)
         return (success, message)
+
+    def channel_history(self, channel, count=None, start=None, end=None):
+        '''(timestamp in ms, nick, message) lines from the first extension
+        keeping channel history, None if none does.'''
+        for function in self.handlers['channel_history']:
+            return function(channel, count, start, end)
+        return None
+
+    def shutdown(self):
+        for function in self.handlers['shutdown']:
+            try:
+                function()
+            except Exception as err:
+                self.logger.error("Extension shutdown failed: %s", err)
+
+    def metrics(self):
+        '''Figures reported by extensions providing a metrics() function, by
+        extension name.'''
+        metrics = dict()
+        for name, module in self.modules.items():
+            if 'metrics' in module.__dict__:
+                metrics[name] = module.metrics()
+        return metrics
@@ -0,0 +1,76 @@
+'''Flood control for client connections (RFC 2813 section 5.8).
+
+Every connection has a penalty timer, which is never behind the current time.
+Each command moves it forward by the command's cost in seconds; while the
+timer is more than `window` seconds ahead of the clock, further commands
+from the connection are held back, and run as the timer catches up.
+
+A client that keeps sending while held back is disconnected for "Excess
+Flood" once `max_deferred` commands are waiting, or, with the "throttle"
+policy, the server stops reading from it until the backlog drains.
+'''
+import time
+
+EXCESS_DISCONNECT = 'disconnect'
+EXCESS_THROTTLE = 'throttle'
+
+# seconds the penalty timer may run ahead of the clock
+FLOOD_WINDOW = 10
+# penalty of commands not listed in COMMAND_COSTS, in seconds
+DEFAULT_COST = 2
+COMMAND_COSTS = {
+    'PASS' : 0,
+    'USER' : 0,
+    'PONG' : 0,
+    'QUIT' : 0,
+    'PING' : 1,
+    'NICK' : 3,
+    'WHOIS' : 3,
+    'NAMES' : 3,
+    'MOTD' : 3,
+    'INFO' : 3,
+    'LUSERS' : 3,
+    'STATS' : 3,
+    'WHO' : 4,
+    'HISTORY' : 4,
+    'LIST' : 6,
+}
+# commands held back before the excess flood policy applies
+MAX_DEFERRED = 100
+
+#
+# Server wide flood settings, shared by all connections.
+#
+class FloodPolicy:
+    def __init__(self, window=FLOOD_WINDOW, default_cost=DEFAULT_COST,
+                 costs=None, max_deferred=MAX_DEFERRED,
+                 excess=EXCESS_DISCONNECT):
+        if excess not in (EXCESS_DISCONNECT, EXCESS_THROTTLE):
+            raise ValueError("Unknown excess flood policy '%s'" % excess)
+        self.window = window
+        self.default_cost = default_cost
+        self.costs = dict(COMMAND_COSTS)
+        if costs is not None:
+            self.costs.update(costs)
+        self.max_deferred = max_deferred
+        self.excess = excess
+
+    def cost(self, command):
+        return self.costs.get(command, self.default_cost)
+
+class PenaltyTimer:
+    def __init__(self, policy, clock=time.monotonic):
+        self.policy = policy
+        self.clock = clock
+        self.timer = clock()
+
+    def ready(self):
+        '''Whether the next command may run now.'''
+        return self.timer - self.clock() <= self.policy.window
+
+    def charge(self, command):
+        self.timer = max(self.timer, self.clock()) + self.policy.cost(command)
+
+    def delay(self):
+        '''Seconds until the next command may run.'''
+        return max(0, self.timer - self.policy.window - self.clock())
@@ -0,0 +1,68 @@
+import re
+
+# RFC 2812 2.3: 512 characters including the trailing CR-LF
+MAX_LINE = 512
+DEFAULT_RECVQ = 8192
+
+_TERMINATOR = re.compile(b'[\r\n]')
+
+#
+# Splits the inbound byte stream of a connection into IRC lines.
+#
+# Data is received straight into a preallocated buffer (see free()), only the
+# newly received bytes are scanned for line terminators, and complete lines
+# are yielded as memoryview slices of that buffer.  Lines longer than the RFC
+# limit are truncated and the remainder discarded, so a client can never make
+# the buffer grow past recvq bytes.
+#
+class LineFramer:
+    def __init__(self, recvq=DEFAULT_RECVQ, max_line=MAX_LINE):
+        self.max_length = max_line - 2
+        self.buffer = bytearray(max(recvq, max_line))
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.discarding = False
+        self.truncated = 0
+
+    def free(self):
+        '''Writable view of the unused tail of the buffer, for recv_into.'''
+        return self.view[self.end:]
+
+    def feed(self, received):
+        '''Account for received bytes written to free() and yield each
+        complete line.  The yielded views are only valid until the next
+        call to feed().'''
+        scan = self.end
+        self.end += received
+        while True:
+            match = _TERMINATOR.search(self.buffer, scan, self.end)
+            if match is None:
+                break
+            scan = match.end()
+            start, stop = self.start, match.start()
+            self.start = scan
+            if self.discarding:
+                self.discarding = False
+                continue
+            if stop == start:
+                # CR-LF pairs and blank lines
+                continue
+            if stop - start > self.max_length:
+                self.truncated += 1
+                stop = start + self.max_length
+            yield self.view[start:stop]
+
+        pending = self.end - self.start
+        if pending > self.max_length:
+            # no terminator within the line limit: deliver what fits and
+            # drop everything up to the next terminator
+            if not self.discarding:
+                self.truncated += 1
+                yield self.view[self.start:self.start + self.max_length]
+            self.discarding = True
+            pending = 0
+        if self.start:
+            self.view[:pending] = self.view[self.end - pending:self.end]
+            self.start = 0
+        self.end = pending
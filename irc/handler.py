@@ -1,8 +1,44 @@
-import asyncore
-import re
+import os
+import time
+from time import perf_counter_ns
 import irc
+import irc.trace as trace
+from collections import deque
+from itertools import islice
+from irc.reactor import Dispatcher
 from irc.client import IrcClient
 from irc.server import IrcServer
+from irc.framer import LineFramer
+from irc.parser import parse
+from irc.commands import command, dispatch_table, ANY, UNREGISTERED
+from irc.ratelimit import TokenBucket
+from irc.flood import PenaltyTimer, EXCESS_THROTTLE
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# bytes of output that may be queued for each class of connection before it
+# is dropped as a slow consumer
+DEFAULT_SENDQ = {
+    'client' : 256 * 1024,
+    'oper' : 1024 * 1024,
+    'server' : 16 * 1024 * 1024,
+}
+
+# seconds a closing connection has to take its remaining output
+DEFAULT_DRAIN_TIMEOUT = 10
+# seconds a connection has to register
+DEFAULT_REGISTRATION_TIMEOUT = 60
+# a client idle for PING_INTERVAL seconds is sent a PING, and dropped if it
+# stays silent for another PING_TIMEOUT
+DEFAULT_PING_INTERVAL = 120
+DEFAULT_PING_TIMEOUT = 60
+
+# ERR_UNKNOWNCOMMAND/ERR_NOTREGISTERED replies per second, and burst size
+ERROR_REPLY_RATE = 1
+ERROR_REPLY_BURST = 5
 
 #
 # A handler instance is spawned when a connection is made to Dispatcher.
@@ -10,11 +46,26 @@ from irc.server import IrcServer
 # server), parses commands, and passes them off to the IrcClient or IrcServer
 # instance for its connection
 #
-class IrcHandler(asyncore.dispatcher):
+@dispatch_table
+class IrcHandler(Dispatcher):
     def __init__(self, socket, server):
-        asyncore.dispatcher.__init__(self, socket)
-        self.out_buffer = bytearray()
-        self.in_buffer = b''
+        Dispatcher.__init__(self, server.reactor, socket)
+        # outbound chunks, the first of which is partially sent up to out_offset
+        self.out_queue = deque()
+        self.out_offset = 0
+        self.out_size = 0
+        # set by close_when_done() and close(): nothing more is read from the
+        # connection and output queued from then on is dropped
+        self.closing = False
+        self.drain_timer = None
+        self.framer = LineFramer(server.recvq)
+
+        # per connection counters for STATS
+        self.connected = time.monotonic()
+        self.sent_bytes = 0
+        self.sent_messages = 0
+        self.received_bytes = 0
+        self.received_messages = 0
 
         self.server = server
         self.server.connections.add(self)
@@ -24,116 +75,278 @@ class IrcHandler(asyncore.dispatcher):
         self.user = None
         self.has_nick = False
         self.has_user = False
-        # TODO verify: need to get hostname, not IP address.
-        self.host = "%s:%d" % socket.getpeername()
+        address = socket.getpeername()
+        self.host = "%s:%d" % address[:2]
+        # the peer address until (and unless) it resolves to a name
+        self.hostname = address[0]
+        if server.resolver is not None:
+            server.resolver.resolve(address[0], self.set_hostname)
+        self.error_replies = TokenBucket(ERROR_REPLY_RATE, ERROR_REPLY_BURST)
         self.registered = False
 
+        # keepalive, the connection's timer on the reactor's wheel is either
+        # the registration timeout or the next idle check
+        self.last_active = self.connected
+        self.ping_sent = None
+        self.reactor.wheel.schedule(self, server.registration_timeout,
+                                    self._registration_expired)
+
+        # flood control, see irc.flood
+        self.penalty = None
+        if server.flood is not None:
+            self.penalty = PenaltyTimer(server.flood)
+        # (parsed message, size) held back by the penalty timer
+        self.deferred = deque()
+        self.deferred_timer = None
+
     def handle_read(self):
-        self.in_buffer += self.recv(8192)
-        received = len(self.in_buffer)
+        received = self.recv_into(self.framer.free())
         self.server.statistics.received.record(received)
-        if received > 0:
-            self.server.logger.debug(self.in_buffer)
-            messages = re.split(b'[\r\n]+', self.in_buffer)
-            # Complete messages end in trailing newlines, yielding empty string.
-            if messages[-1] != b'':
-                self.in_buffer = messages[-1]
+        self.received_bytes += received
+        self.last_active = time.monotonic()
+        for line in self.framer.feed(received):
+            self.received_messages += 1
+            size = len(line)
+            line = str(line, 'utf-8', 'replace')
+            if trace.ENABLED:
+                trace.received(self.nick, line)
+            message = parse(line)
+            if message is None:
+                continue
+            if self.admit(message):
+                self.execute(message, size)
             else:
-                self.in_buffer = b''
-            for message in messages[:-1]:
-                self.server.logger.debug(message)
-                self.dispatch(bytes.decode(message))
+                self.defer(message, size)
+            if self.closing:
+                break
+
+    def flood_exempt(self):
+        '''Operators and server links are not subject to flood control.'''
+        handler = self.handler
+        return isinstance(handler, IrcServer) or \
+            (isinstance(handler, IrcClient) and handler.is_op())
+
+    def admit(self, message):
+        '''Charge message to the penalty timer if it may run now.'''
+        if self.penalty is None or self.flood_exempt():
+            return True
+        if self.deferred or not self.penalty.ready():
+            return False
+        self.penalty.charge(message.command)
+        return True
+
+    def defer(self, message, size):
+        self.deferred.append((message, size))
+        policy = self.server.flood
+        if len(self.deferred) >= policy.max_deferred:
+            if policy.excess != EXCESS_THROTTLE:
+                self.excess_flood()
+                return
+            self.want_read(False)
+        if self.deferred_timer is None:
+            self.deferred_timer = self.reactor.call_later(
+                self.penalty.delay(), self._run_deferred)
+
+    def _run_deferred(self):
+        self.deferred_timer = None
+        deferred = self.deferred
+        while deferred and not self.closing:
+            if not self.flood_exempt():
+                if not self.penalty.ready():
+                    self.deferred_timer = self.reactor.call_later(
+                        self.penalty.delay(), self._run_deferred)
+                    return
+                self.penalty.charge(deferred[0][0].command)
+            self.execute(*deferred.popleft())
+        if not self.closing:
+            self.want_read(True)
+
+    def excess_flood(self):
+        self.server.logger.info("Excess flood from %s (%s)",
+                                self.nick, self.host)
+        self.deferred.clear()
+        if isinstance(self.handler, IrcClient):
+            self.handler.cmd_quit(['Excess Flood'])
+        else:
+            self.raw_send('ERROR :Closing Link: %s (Excess Flood)\r\n' %
+                          self.hostname)
+            self.close_when_done()
 
     def handle_write(self):
         self._flush()
 
     def _flush(self):
-        sent = self.send(self.out_buffer)
+        queue = self.out_queue
+        buffers = list(islice(queue, IOV_MAX))
+        if self.out_offset:
+            buffers[0] = memoryview(buffers[0])[self.out_offset:]
+        sent = self.sendmsg(buffers)
         self.server.statistics.sent.record(sent)
-        self.out_buffer = self.out_buffer[sent:]
+        self.sent_bytes += sent
+        if self.socket is None:
+            # the connection was dropped while sending
+            return
+        self.out_size -= sent
+        sent += self.out_offset
+        while sent and sent >= len(queue[0]):
+            sent -= len(queue.popleft())
+        self.out_offset = sent
+        if not queue:
+            self.want_write(False)
+            if self.closing:
+                self.close()
+
+    def _discard_output(self):
+        self.out_queue = deque()
+        self.out_offset = 0
+        self.out_size = 0
+
+    def _registration_expired(self):
+        if self.registered or self.closing:
+            return
+        self.server.logger.info("Registration timeout for %s", self.host)
+        self.raw_send('ERROR :Closing Link: %s (Registration timed out)\r\n' %
+                      self.hostname)
+        self.close_when_done()
+
+    def _keepalive(self):
+        '''Idle check: PING the client once it has been quiet for the ping
+        interval, and drop it if it's still quiet after the ping timeout.'''
+        if self.closing:
+            return
+        server = self.server
+        if self.ping_sent is not None and self.last_active > self.ping_sent:
+            self.ping_sent = None
+        now = time.monotonic()
+        if self.ping_sent is None:
+            idle = now - self.last_active
+            if idle < server.ping_interval:
+                self.reactor.wheel.schedule(self, server.ping_interval - idle,
+                                            self._keepalive)
+                return
+            self.raw_send('PING :%s\r\n' % server.name)
+            self.ping_sent = now
+            self.reactor.wheel.schedule(self, server.ping_timeout,
+                                        self._keepalive)
+            return
+        self.handler.cmd_quit(['Ping timeout: %d seconds' %
+                               (now - self.last_active)])
+
+    def handle_close(self):
+        # the peer is gone, anything still queued can never be delivered
+        self._discard_output()
+        if isinstance(self.handler, IrcClient):
+            # let the channels know, unless QUIT already did; output to us is
+            # dropped from here on
+            self.closing = True
+            self.handler.cmd_quit(['Connection closed'])
+        self.close()
+
+    def close_when_done(self):
+        '''Stop reading and close once the queued output has been sent, or
+        when the server's drain_timeout runs out, whichever comes first.
+        Output is sent by the loop as the socket becomes writable.'''
+        self.closing = True
+        self._cancel_deferred()
+        if self.socket is None:
+            return
+        if not self.out_size:
+            self.close()
+            return
+        self.want_read(False)
+        if self.drain_timer is None:
+            self.drain_timer = self.reactor.call_later(
+                self.server.drain_timeout, self._drain_expired)
+
+    def _drain_expired(self):
+        self.drain_timer = None
+        self.server.logger.info("Dropping %d bytes of output to %s (%s), "
+                                "closed link didn't drain in time",
+                                self.out_size, self.nick, self.host)
+        self.close()
 
     def close(self):
-        while len(self.out_buffer):
-            self._flush()
-        asyncore.dispatcher.close(self)
-
-    def parse(self, message):
-        # this stuff will be useful for the server, but the client message
-        # syntax is simpler (prefixes are ignored, for example)
-        #hostname = '[-a-zA-Z0-9.]+' # FIXME: this is overly simple
-        #nick     = '[a-zA-Z\[\]\\`_^{}]+[-a-zA-Z\[\]\\`_^{}]'
-        #user     = '[\x01-\x09\x0b-\x0c\x0e-\x1f\x21-\x3f\x41-\xff]+'
-
-        #prefix  =
-        # '(?::(?P<prefix>%s|%s!%s@%s) +)?' % (hostname, nick, user, hostname)
-        #command = '(?P<command>[a-zA-Z]+|\d\d\d)'
-        #params  = '(?P<params>.*)'
-
-        #message_pattern = '%s%s +%s' % (prefix, command, params)
-
-        #if match = re.match(message_pattern, message):
-        #    return match.groupdict()
-
-        # FIXME: is this good enough for servers???
-
-        # TODO: prefix MUST be ignored from clients
-        prefix = None
-        match = re.match(':([^ ]+) +', message)
-        if match:
-            prefix  = match.groups()[0]
-            message = message[match.end():]
-
-        trailing = None
-        match = re.search(':(.*)$', message)
-        if match:
-            trailing = match.groups()[0]
-            message = message[:match.start()]
-
-        params  = message.split()
-        if trailing != None:
-            params.append(trailing)
-
-        command = params[0].upper()
-        params = params[1:]
-
-        return (prefix, command, params)
-
-    def dispatch(self, msg):
-        prefix, command, args = self.parse(msg)
-        self.server.logger.debug('received from %s: prefix=%s ' \
-                                 'command=%s args=%s',
-                                 self.nick, prefix, command, args)
-
-        if command == 'PASS':
-            pass
-            #TODO password hashing
-        elif command == 'NICK' and not isinstance(self.handler, IrcServer):
-            self.cmd_nick(args)
-        elif command == 'USER':
-            self.cmd_user(args)
-        elif command == 'SERVER' and self.handler is None:
-            self.cmd_server(args)
-        else:
-            if self.handler is not None:
+        '''Close the connection immediately, dropping any queued output.'''
+        self.closing = True
+        self._cancel_deferred()
+        if self.drain_timer is not None:
+            self.drain_timer.cancel()
+            self.drain_timer = None
+        self._discard_output()
+        self.reactor.wheel.cancel(self)
+        self.server.connections.discard(self)
+        Dispatcher.close(self)
+
+    def _cancel_deferred(self):
+        self.deferred.clear()
+        if self.deferred_timer is not None:
+            self.deferred_timer.cancel()
+            self.deferred_timer = None
+
+    def execute(self, message, size):
+        '''Dispatch message, accounting the time taken to its command.'''
+        started = perf_counter_ns()
+        self.dispatch(message)
+        self.server.statistics.commands.record(
+            message.command, size, perf_counter_ns() - started,
+            isinstance(self.handler, IrcServer))
+
+    def dispatch(self, message):
+        prefix, command, args = message
+
+        if isinstance(self.handler, IrcServer):
+            if command != 'PASS':
                 self.handler.cmd(prefix, command, args)
-            else:
-                format_str = "Command %s was sent before USER or SERVER: %s"
-                self.server.logger.error(format_str,
-                                         command,
-                                         msg)
+            return
 
+        entry = self.COMMANDS.get(command)
+        if entry is not None:
+            if entry.registered is UNREGISTERED and self.registered:
+                self.reply(irc.ERR_ALREADYREGISTRED)
+            elif len(args) < entry.min_params:
+                self.reply(irc.ERR_NEEDMOREPARAMS, command=command)
+            else:
+                entry.handler(self, args)
+        elif self.handler is not None:
+            self.handler.cmd(prefix, command, args)
+        elif command in IrcClient.COMMANDS:
+            if self.error_replies.consume():
+                self.reply(irc.ERR_NOTREGISTERED)
+        else:
+            self.unknown_command(command)
+
+    def unknown_command(self, command):
+        '''Reply ERR_UNKNOWNCOMMAND, rate limited so that a client sending
+        garbage can't make us flood it (or the log) in return.'''
+        if self.error_replies.consume():
+            self.server.logger.debug("Unknown command %s from %s",
+                                     command, self.nick)
+            self.reply(irc.ERR_UNKNOWNCOMMAND, command=command)
+
+    @command(min_params=1, registered=UNREGISTERED)
+    def cmd_pass(self, args):
+        pass
+        #TODO password hashing
+
+    @command(registered=ANY)
     def cmd_nick(self, args):
-        # TODO: err irc.ERR_UNAVAILRESOURCE
         if not len(args):
             self.reply(irc.ERR_NONICKNAMEGIVEN)
             return
 
-        # TODO: validate nickname (irc.ERR_ERRONEUSNICKNAME)
-
         nick = args[0]
-        if nick in self.server.clients:
+        if not irc.is_valid_nick(nick):
+            self.reply(irc.ERR_ERRONEUSNICKNAME, nickname=nick)
+            return
+
+        # a registered client may change the case of its own nick
+        if irc.irc_lower(nick) != irc.irc_lower(self.nick or '') and \
+                nick in self.server.clients:
             self.reply(irc.ERR_NICKNAMEINUSE, nickname=nick)
             return
+        if self.server.nick_delayed(nick):
+            self.reply(irc.ERR_UNAVAILRESOURCE, name=nick)
+            return
 
         # TODO: nickname collision (irc.ERR_NICKCOLLISION) multiple server stuff
 
@@ -143,9 +356,13 @@ class IrcHandler(asyncore.dispatcher):
         # that's how we should do it too
         if self.registered:
             old_nick = self.nick
-            # TODO: nick delay mechanism
-            self.server.clients[nick] = self.handler
             del self.server.clients[old_nick]
+            self.server.clients[nick] = self.handler
+            # channels re-render NAMES from the new nick
+            self.nick = nick
+            self.handler.invalidate_prefix()
+            for channel in self.handler.channels:
+                channel.rename(old_nick, nick)
 
         self.nick = nick
         self.has_nick = True
@@ -153,14 +370,13 @@ class IrcHandler(asyncore.dispatcher):
         if self.has_user and not self.registered:
             self.register()
 
-    def cmd_user(self, args):
-        if len(args) < 4:
-            self.reply(irc.ERR_NEEDMOREPARAMS, command='USER')
-            return
-
-        if self.registered:
-            self.reply(irc.ERR_ALREADYREGISTRED)
+    @command(registered=ANY)
+    def cmd_pong(self, args):
+        # any traffic counts as activity, see _keepalive
+        pass
 
+    @command(min_params=4, registered=UNREGISTERED)
+    def cmd_user(self, args):
         user = args[0]
         mode = args[1]
         realname = args[3]
@@ -170,14 +386,13 @@ class IrcHandler(asyncore.dispatcher):
         if self.has_nick:
             self.register()
 
+    @command(min_params=4, registered=UNREGISTERED)
     def cmd_server(self, args):
-        if len(args) != 4:
-            self.reply(irc.ERR_NEEDMOREPARAMS, command='SERVER')
-
-        servername, hopcount, token, info = args
+        servername, hopcount, token, info = args[:4]
         self.server.logger.info("Registered server connection %s", servername)
         self.nick = servername
         self.registered = True
+        self.reactor.wheel.cancel(self)
         self.handler = IrcServer(self, self.server)
         self.server.servers[self.nick] = self.handler
         self.handler.hopcount = int(hopcount)
@@ -215,62 +430,123 @@ class IrcHandler(asyncore.dispatcher):
                     servertoken=client.servertoken(), umode='+i')
 
     def register(self):
-        # TODO? write a nick-changing method that checks for this nick
-        # (race condition?)
+        if self.nick in self.server.clients:
+            # another connection registered the nick since our NICK
+            self.reply(irc.ERR_NICKNAMEINUSE, nickname=self.nick)
+            self.has_nick = False
+            return
         self.registered = True
-        self.reply(irc.RPL_WELCOME,
-                   nick=self.nick,
-                   user=self.user[0],
-                   host=self.host)
-        self.reply(irc.RPL_YOURHOST,
-                   server=self.server.name,
-                   version=self.server.version)
-        self.reply(irc.RPL_CREATED,
-                   launched=self.server.launched)
-        self.reply(irc.RPL_MYINFO,
-                   server=self.server.name,
-                   version=self.server.version,
-                   user_modes=irc.mode_str(self.server.user_modes),
-                   channel_modes=irc.mode_str(self.server.channel_modes))
+        self.replies([
+            (irc.RPL_WELCOME, dict(nick=self.nick,
+                                   user=self.user[0],
+                                   host=self.hostname)),
+            (irc.RPL_YOURHOST, dict(server=self.server.name,
+                                    version=self.server.version)),
+            (irc.RPL_CREATED, dict(launched=self.server.launched)),
+            (irc.RPL_MYINFO, dict(server=self.server.name,
+                                  version=self.server.version,
+                                  user_modes=irc.mode_str(self.server.user_modes),
+                                  channel_modes=irc.mode_str(self.server.channel_modes))),
+        ])
         self.handler = IrcClient(self, self.server)
         self.server.clients[self.nick] = self.handler
+        self.reactor.wheel.schedule(self, self.server.ping_interval,
+                                    self._keepalive)
 
         msg = 'NICK {nick} {hopcount} {username} {host} ' \
               '{servertoken} {umode} :{realname}\r\n'.format(
                   nick=self.nick, hopcount=0, username=self.user[0],
-                  host=self.user[1], servertoken=self.server.token, umode='+i',
+                  host=self.hostname, servertoken=self.server.token, umode='+i',
                   realname=self.user[2])
         for server in self.server.servers.values():
             server.connection.raw_send(msg)
 
     def _err_need_more_params(self, command):
-        self.reply(irc.ERR_NEEDMOREPARAMS,
-                   '%s :Not enough parameters' % command)
+        self.reply(irc.ERR_NEEDMOREPARAMS, command=command)
 
     def reply(self, code, **format_args):
-        name, message = irc.IRC_CODE[code]
-        formatted_message = message % format_args
-        msg = '%s %03d %s %s\n' % (self.server.prefix(),
-                                   code,
-                                   self.nick or "*",
-                                   formatted_message)
-        self.server.logger.debug("sent %s to %s", name, self.nick)
-        self.raw_send(msg)
+        data = self.server.replies.render(self._reply_nick(), code, format_args)
+        if trace.ENABLED:
+            trace.sent(self.nick, data)
+        self.queue(data)
+
+    def replies(self, replies):
+        '''Send a sequence of (code, format_args) numerics with one append to
+        the output queue.'''
+        self._queue_replies(
+            self.server.replies.render_many(self._reply_nick(), replies))
+
+    def reply_block(self, block):
+        '''Send a ReplyBlock pre-rendered by ReplyTemplates.block().'''
+        self._queue_replies(block.render(self._reply_nick()))
+
+    def _queue_replies(self, data):
+        if trace.ENABLED:
+            for line in data.splitlines():
+                trace.sent(self.nick, line)
+        if data:
+            self.queue(data)
+
+    def _reply_nick(self):
+        if self.nick is None:
+            return b'*'
+        return self.nick.encode()
 
     def raw_send(self, message):
-        self.server.logger.debug("sent to %s: '%s'",
-                                 self.nick,
-                                 message.rstrip("\r\n"))
-        self.out_buffer += message.encode()
-
-    def readable(self):
-        return True
-
-    def writable(self):
-        return (len(self.out_buffer) > 0)
+        if trace.ENABLED:
+            trace.sent(self.nick, message)
+        self.queue(message.encode())
+
+    def queue(self, data):
+        '''Queue already encoded bytes for sending.  Broadcasts encode a line
+        once and queue the same bytes object for every recipient.'''
+        if self.closing:
+            return
+        if not self.out_size:
+            self.want_write(True)
+        self.out_queue.append(data)
+        self.out_size += len(data)
+        self.sent_messages += 1
+        if self.out_size > self.server.sendq_min and \
+                self.out_size > self.sendq_limit():
+            self.max_sendq_exceeded()
+
+    def sendq_class(self):
+        if isinstance(self.handler, IrcServer):
+            return 'server'
+        if isinstance(self.handler, IrcClient) and self.handler.is_op():
+            return 'oper'
+        return 'client'
+
+    def sendq_limit(self):
+        return self.server.sendq[self.sendq_class()]
+
+    def max_sendq_exceeded(self):
+        # queue() is called while iterating over channel members and the
+        # like, so the connection is dropped from the loop afterwards
+        self.server.logger.info("Max SendQ exceeded for %s (%s): %d bytes",
+                                self.nick, self.host, self.out_size)
+        self.closing = True
+        self._discard_output()
+        self.reactor.call_soon(self._drop_slow_consumer)
+
+    def _drop_slow_consumer(self):
+        # runs even if the socket has gone meanwhile, cmd_quit and squit
+        # clean up whatever is left
+        if isinstance(self.handler, IrcClient):
+            self.handler.cmd_quit(['Max SendQ exceeded'])
+        elif isinstance(self.handler, IrcServer):
+            if self.nick in self.server.servers:
+                self.server.squit(self.nick, 'Max SendQ exceeded')
+        else:
+            self.close()
 
-    def _host(self):
-        return self.getsockname()[0]
+    def set_hostname(self, hostname):
+        if hostname == self.hostname:
+            return
+        self.hostname = hostname
+        if isinstance(self.handler, IrcClient):
+            self.handler.invalidate_prefix()
 
     def __repr__(self):
         return "<IrcClient: nick=%s registered=%s user=%s>" % \
@@ -0,0 +1,87 @@
+'''Logging helpers: background writers and sampling of repeated messages.'''
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+# QueueListeners started by queue_handler, until stop_listeners()
+LISTENERS = []
+
+def queue_handler(target):
+    '''Return a QueueHandler whose records are written to target by a
+    QueueListener thread, keeping file I/O off the event loop.'''
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, target,
+                                              respect_handler_level=True)
+    listener.start()
+    LISTENERS.append(listener)
+    return logging.handlers.QueueHandler(records)
+
+def stop_listeners():
+    '''Write out the records still queued and stop the listener threads.
+    Must be called before os._exit(), which skips atexit hooks; registered
+    with atexit for every other way out.'''
+    while LISTENERS:
+        LISTENERS.pop().stop()
+
+atexit.register(stop_listeners)
+
+#
+# Passes at most `burst` records per `interval` seconds from each logging call
+# site (file and line).  The next record let through after some were dropped
+# is annotated with the number of suppressed messages.
+#
+class SamplingFilter(logging.Filter):
+    def __init__(self, interval, burst, clock=time.monotonic):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.clock = clock
+        self.sites = dict()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = self.clock()
+        window, count, suppressed = self.sites.get(key, (now, 0, 0))
+        if now - window >= self.interval:
+            window, count = now, 0
+        if count >= self.burst:
+            self.sites[key] = (window, count, suppressed + 1)
+            return False
+        self.sites[key] = (window, count + 1, 0)
+        if suppressed:
+            record.msg = '%s (%d similar messages suppressed)' % \
+                (record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+#
+# Measures the phases of a longer operation, such as starting the daemon:
+#
+#     timer = PhaseTimer()
+#     ...
+#     timer.mark('config')
+#     ...
+#     timer.mark('bind')
+#     logger.info('Started in %s', timer)
+#
+class PhaseTimer:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = self.last = clock()
+        self.phases = []
+
+    def mark(self, phase):
+        '''End the current phase, naming it.'''
+        now = self.clock()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.started
+
+    def __str__(self):
+        phases = ', '.join('%s %.1fms' % (phase, elapsed * 1000)
+                           for phase, elapsed in self.phases)
+        return '%.1fms (%s)' % (self.total() * 1000, phases)
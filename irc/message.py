@@ -24,9 +24,3 @@ class IrcClientMessageMixin:
 
     def helper_chan_op_privs_needed(self, channel):
         self.connection.reply(irc.ERR_CHANOPRIVSNEEDED, channel=channel)
-
-    def prefix(self):
-        nick = self.connection.nick
-        username = self.connection.user[0]
-        host = self.connection.getsockname()[0]
-        return ":%s!%s@%s" % (nick, username, host)
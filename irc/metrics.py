@@ -0,0 +1,230 @@
+'''HTTP metrics endpoint.
+
+An optional listener, served by the same reactor as the IRC port, that
+answers
+    GET /metrics          Prometheus text exposition format
+    GET /metrics.json     the same figures, plus the statistic series, as JSON
+Requests are answered from the server's in-memory state and never touch the
+IRC protocol path.  Enable it with:
+    [metrics]
+    port = 9667
+'''
+import json
+import socket as _socket
+from irc.reactor import Dispatcher
+from irc.statistics import RESOLUTIONS
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+# largest request accepted, headers included
+MAX_REQUEST = 8192
+# seconds between loop lag measurements
+LAG_INTERVAL = 1.0
+# command latency histogram bounds exported, as log2 nanosecond buckets:
+# 1us, 4us, 16us ... ~17s
+EXPORTED_BUCKETS = range(10, 36, 2)
+STATISTICS = ('sent', 'received', 'messages')
+
+#
+# Measures how late the loop runs a timer, which is how long events wait
+# behind whatever the loop is busy with.
+#
+class LoopLagMonitor:
+    def __init__(self, reactor, interval=LAG_INTERVAL):
+        self.reactor = reactor
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._schedule()
+
+    def _schedule(self):
+        self.due = self.reactor.clock() + self.interval
+        self.reactor.call_later(self.interval, self._measure)
+
+    def _measure(self):
+        self.lag = max(0.0, self.reactor.clock() - self.due)
+        self.max_lag = max(self.max_lag, self.lag)
+        self._schedule()
+
+def collect(server):
+    '''Snapshot of the server's metrics as a dictionary.'''
+    connections = server.connections
+    sendq = [connection.out_size for connection in connections]
+    statistics = server.statistics
+    commands = dict()
+    for command, entry in statistics.commands.commands.items():
+        commands[command] = {
+            'count' : entry.count,
+            'remote' : entry.remote,
+            'bytes' : entry.bytes,
+            'seconds' : entry.elapsed / 1e9,
+            'p50_seconds' : entry.percentile(0.5) / 1e9,
+            'p99_seconds' : entry.percentile(0.99) / 1e9,
+            'histogram' : list(entry.histogram),
+        }
+    series = dict()
+    for name in STATISTICS:
+        statistic = getattr(statistics, name)
+        statistic.check()
+        series[name] = {
+            'total' : statistic.total,
+            'dropped' : dict(statistic.dropped),
+            'points' : dict((resolution, statistic.points(resolution))
+                            for resolution, step, size in RESOLUTIONS),
+        }
+    return {
+        'server' : server.name,
+        'version' : server.version,
+        'time' : server.reactor.cached_time(),
+        'connections' : len(connections),
+        'clients' : len(server.clients),
+        'servers' : len(server.servers),
+        'unknown' : len([connection for connection in connections
+                         if not connection.registered]),
+        'channels' : len(server.channels),
+        'sendq_bytes' : sum(sendq),
+        'sendq_max_bytes' : max(sendq, default=0),
+        'loop_lag_seconds' : server.loop_lag.lag,
+        'loop_lag_max_seconds' : server.loop_lag.max_lag,
+        'commands' : commands,
+        'statistics' : series,
+        'extensions' : server.extensions.metrics(),
+    }
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in sorted(labels.items()))
+
+def render_prometheus(metrics):
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append('# HELP irked_%s %s' % (name, help))
+        lines.append('# TYPE irked_%s %s' % (name, kind))
+        for labels, value in samples:
+            lines.append('irked_%s%s %s' % (name, labels, repr(value)))
+
+    for name, help in (('connections', 'Open connections.'),
+                       ('clients', 'Registered clients.'),
+                       ('servers', 'Linked servers.'),
+                       ('unknown', 'Connections that have not registered.'),
+                       ('channels', 'Channels.'),
+                       ('sendq_bytes', 'Output queued on all connections.'),
+                       ('sendq_max_bytes',
+                        'Output queued on the fullest connection.'),
+                       ('loop_lag_seconds',
+                        'How late the event loop last ran a timer.'),
+                       ('loop_lag_max_seconds',
+                        'Largest loop lag since startup.')):
+        metric(name, 'gauge', help, [('', metrics[name])])
+
+    series = metrics['statistics']
+    metric('bytes_sent_total', 'counter', 'Bytes sent.',
+           [('', series['sent']['total'])])
+    metric('bytes_received_total', 'counter', 'Bytes received.',
+           [('', series['received']['total'])])
+    metric('messages_total', 'counter', 'Messages relayed.',
+           [('', series['messages']['total'])])
+    metric('statistic_dropped_total', 'counter',
+           'Statistic points that could not be recorded.',
+           [(_labels(statistic=name, reason=reason), count)
+            for name in STATISTICS
+            for reason, count in sorted(series[name]['dropped'].items())])
+
+    metric('extension', 'gauge', 'Figures reported by extensions.',
+           [(_labels(extension=extension, metric=name), value)
+            for extension, figures in sorted(metrics['extensions'].items())
+            for name, value in sorted(figures.items())])
+
+    commands = sorted(metrics['commands'].items())
+    metric('command_calls_total', 'counter', 'Commands handled.',
+           [(_labels(command=command, origin=origin), entry[key])
+            for command, entry in commands
+            for origin, key in (('local', 'count'), ('remote', 'remote'))])
+    metric('command_bytes_total', 'counter', 'Bytes of commands received.',
+           [(_labels(command=command), entry['bytes'])
+            for command, entry in commands])
+    samples = []
+    for command, entry in commands:
+        histogram = entry['histogram']
+        for bucket in EXPORTED_BUCKETS:
+            bound = repr(2 ** bucket / 1e9)
+            samples.append((_labels(command=command, le=bound),
+                            sum(histogram[:bucket + 1])))
+        samples.append((_labels(command=command, le='+Inf'), sum(histogram)))
+    lines.append('# HELP irked_command_duration_seconds Time taken to '
+                 'handle commands.')
+    lines.append('# TYPE irked_command_duration_seconds histogram')
+    for labels, value in samples:
+        lines.append('irked_command_duration_seconds_bucket%s %d' %
+                     (labels, value))
+    for command, entry in commands:
+        lines.append('irked_command_duration_seconds_sum%s %r' %
+                     (_labels(command=command), entry['seconds']))
+        lines.append('irked_command_duration_seconds_count%s %d' %
+                     (_labels(command=command), sum(entry['histogram'])))
+    lines.append('')
+    return '\n'.join(lines)
+
+def render_json(metrics):
+    return json.dumps(metrics, sort_keys=True)
+
+#
+# One HTTP request.  The connection is closed once the response is sent.
+#
+class MetricsConnection(Dispatcher):
+    def __init__(self, reactor, sock, server):
+        Dispatcher.__init__(self, reactor, sock)
+        self.server = server
+        self.request = b''
+        self.response = None
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if not data or self.response is not None:
+            return
+        self.request += data
+        if b'\r\n\r\n' in self.request or b'\n\n' in self.request:
+            self.respond(self.request.split(b'\n', 1)[0])
+        elif len(self.request) > MAX_REQUEST:
+            self.respond(None)
+
+    def respond(self, request_line):
+        parts = request_line.split() if request_line else []
+        if len(parts) < 2:
+            status, body, content_type = '400 Bad Request', 'bad request\n', \
+                'text/plain'
+        elif parts[0] != b'GET':
+            status, body, content_type = '405 Method Not Allowed', \
+                'method not allowed\n', 'text/plain'
+        elif parts[1] == b'/metrics':
+            status, content_type = '200 OK', 'text/plain; version=0.0.4'
+            body = render_prometheus(collect(self.server))
+        elif parts[1] == b'/metrics.json':
+            status, content_type = '200 OK', 'application/json'
+            body = render_json(collect(self.server))
+        else:
+            status, body, content_type = '404 Not Found', 'not found\n', \
+                'text/plain'
+        body = body.encode()
+        head = 'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n' \
+               'Connection: close\r\n\r\n' % (status, content_type, len(body))
+        self.response = memoryview(head.encode() + body)
+        self.want_read(False)
+        self.want_write(True)
+
+    def handle_write(self):
+        sent = self.send(self.response)
+        self.response = self.response[sent:]
+        if not len(self.response):
+            self.close()
+
+class MetricsListener(Dispatcher):
+    def __init__(self, server, address):
+        Dispatcher.__init__(self, server.reactor)
+        self.server = server
+        self.create_socket(_socket.AF_INET, _socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(16)
+
+    def handle_accepted(self, sock, address):
+        MetricsConnection(self.reactor, sock, self.server)
@@ -0,0 +1,45 @@
+'''IRC message parser (RFC 2812 section 2.3.1)'''
+from collections import namedtuple
+
+# at most 14 middle parameters, anything after them is the trailing parameter
+MAX_MIDDLE = 14
+
+Message = namedtuple('Message', 'prefix command params')
+# skips the argument handling of the generated Message.__new__
+_new_message = tuple.__new__
+
+def parse(line):
+    '''Parse one line (without CR-LF) into a Message.  The command is upper
+    cased.  Returns None for lines that carry no command.
+
+        message    =  [ ":" prefix SPACE ] command [ params ]
+        params     =  *14( SPACE middle ) [ SPACE ":" trailing ]
+                   =/ 14( SPACE middle ) [ SPACE [ ":" ] trailing ]
+    '''
+    prefix = None
+    if line.startswith(':'):
+        prefix, _, line = line[1:].partition(' ')
+
+    trailing = None
+    split = line.find(' :')
+    if split >= 0:
+        trailing = line[split + 2:]
+        line = line[:split]
+
+    params = line.split(' ')
+    if '' in params:
+        params = [param for param in params if param]
+    if not params or params[0].startswith(':'):
+        return None
+    command = params[0].upper()
+    del params[0]
+
+    if len(params) > MAX_MIDDLE:
+        rest = ' '.join(params[MAX_MIDDLE:])
+        if trailing is not None:
+            rest = '%s :%s' % (rest, trailing)
+        del params[MAX_MIDDLE:]
+        trailing = rest
+    if trailing is not None:
+        params.append(trailing)
+    return _new_message(Message, (prefix, command, params))
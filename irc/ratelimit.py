@@ -0,0 +1,23 @@
+import time
+
+#
+# Token bucket: holds up to `burst` tokens and refills at `rate` tokens per
+# second.  consume() reports whether enough tokens were available.
+#
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+
+    def consume(self, cost=1):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
@@ -0,0 +1,335 @@
+import errno
+import heapq
+import itertools
+import logging
+import selectors
+import socket as _socket
+import time
+from collections import deque
+from irc.timerwheel import TimingWheel
+
+_DISCONNECTED = frozenset({errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+                           errno.ECONNABORTED, errno.EPIPE, errno.EBADF})
+
+#
+# The reactor owns the selector (epoll/kqueue where available) and runs the
+# event loop.  Unlike asyncore it does not poll every handler on each pass:
+# handlers are registered once for reading and only ask for write events while
+# they have data queued, so an idle connection costs nothing per iteration.
+#
+# As with asyncore, an exception escaping a handler closes that handler only,
+# and one escaping a timer or callback is logged, never stopping the loop.
+#
+class Reactor:
+    def __init__(self, clock=time.monotonic, logger=None):
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        self.clock = clock
+        self.logger = logger or logging.getLogger(__name__)
+        # wall clock time, read once per pass of the loop, see cached_time
+        self.time = time.time()
+        # callbacks to run on the next pass, see call_soon
+        self.pending = deque()
+        # heap of (when, sequence, Timer), see call_later
+        self.timers = []
+        self._sequence = itertools.count()
+        # keyed coarse timers, for the ones every connection has
+        self.wheel = TimingWheel(clock=clock, run=self.run_callback)
+        self._waker, self._wake = _socket.socketpair()
+        self._waker.setblocking(False)
+        self._wake.setblocking(False)
+        self.selector.register(self._waker, selectors.EVENT_READ, None)
+
+    def register(self, dispatcher, events):
+        self.selector.register(dispatcher.socket, events, dispatcher)
+
+    def modify(self, dispatcher, events):
+        self.selector.modify(dispatcher.socket, events, dispatcher)
+
+    def unregister(self, dispatcher):
+        try:
+            self.selector.unregister(dispatcher.socket)
+        except (KeyError, ValueError):
+            pass
+
+    def loop(self, timeout=None):
+        self.running = True
+        while self.running:
+            self.poll(timeout)
+
+    def poll(self, timeout=None):
+        if self.pending:
+            timeout = 0
+        else:
+            if self.timers:
+                due = max(0, self.timers[0][0] - self.clock())
+                if timeout is None or due < timeout:
+                    timeout = due
+            due = self.wheel.timeout()
+            if due is not None and (timeout is None or due < timeout):
+                timeout = due
+        events = self.selector.select(timeout)
+        self.time = time.time()
+        for key, mask in events:
+            dispatcher = key.data
+            if dispatcher is None:
+                self._drain_waker()
+                continue
+            if dispatcher.socket is None:
+                continue
+            try:
+                if mask & selectors.EVENT_READ:
+                    dispatcher.handle_read_event()
+                if mask & selectors.EVENT_WRITE and \
+                        dispatcher.socket is not None:
+                    dispatcher.handle_write_event()
+            except Exception:
+                dispatcher.handle_error()
+        self.run_timers()
+        self.wheel.advance()
+        self.run_pending()
+
+    def cached_time(self):
+        '''time.time() as of the start of this pass of the loop, for
+        timestamps that don't need to be more precise than that.'''
+        return self.time
+
+    def call_soon(self, callback, *args):
+        '''Run callback(*args) from the loop on its next pass.'''
+        self.pending.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        '''call_soon for use from other threads, wakes the loop up.'''
+        self.pending.append((callback, args))
+        try:
+            self._wake.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def call_later(self, delay, callback, *args):
+        '''Run callback(*args) from the loop after delay seconds.  Returns a
+        Timer that can be cancelled.  For timers kept per connection, use
+        the coarser but cheaper self.wheel.'''
+        timer = Timer(callback, args)
+        heapq.heappush(self.timers,
+                       (self.clock() + delay, next(self._sequence), timer))
+        return timer
+
+    def run_timers(self):
+        timers = self.timers
+        now = self.clock()
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if timer.callback is not None:
+                callback, args = timer.callback, timer.args
+                timer.cancel()
+                self.run_callback(callback, args)
+
+    def run_pending(self):
+        # callbacks added while running wait for the next pass
+        for i in range(len(self.pending)):
+            callback, args = self.pending.popleft()
+            self.run_callback(callback, args)
+
+    def run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            self.logger.exception("uncaptured python exception in callback %r",
+                                  callback)
+
+    def _drain_waker(self):
+        try:
+            while self._waker.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.selector.close()
+        self._waker.close()
+        self._wake.close()
+
+class Timer:
+    __slots__ = ('callback', 'args')
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        # the heap entry stays behind and is skipped when it comes due
+        self.callback = None
+        self.args = None
+
+#
+# Minimal replacement for asyncore.dispatcher bound to a Reactor.  Subclasses
+# override handle_read, handle_write and handle_accepted, and call
+# want_write() to toggle write interest on the selector.  want_read(False)
+# stops reading from the socket, leaving the peer to TCP flow control.
+#
+class Dispatcher:
+    accepting = False
+
+    def __init__(self, reactor, sock=None):
+        self.reactor = reactor
+        self.socket = None
+        self.events = selectors.EVENT_READ
+        if sock is not None:
+            self.set_socket(sock)
+
+    def set_socket(self, sock):
+        sock.setblocking(False)
+        self.socket = sock
+        self.reactor.register(self, self.events)
+
+    def create_socket(self, family=_socket.AF_INET, type=_socket.SOCK_STREAM):
+        self.set_socket(_socket.socket(family, type))
+
+    def set_reuse_addr(self):
+        self.socket.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEADDR, 1)
+
+    def bind(self, address):
+        self.socket.bind(address)
+
+    def listen(self, backlog):
+        self.accepting = True
+        self.socket.listen(backlog)
+
+    def want_write(self, enable):
+        if enable:
+            self._set_events(self.events | selectors.EVENT_WRITE)
+        else:
+            self._set_events(self.events & ~selectors.EVENT_WRITE)
+
+    def want_read(self, enable):
+        if enable:
+            self._set_events(self.events | selectors.EVENT_READ)
+        else:
+            self._set_events(self.events & ~selectors.EVENT_READ)
+
+    def _set_events(self, events):
+        if events == self.events or self.socket is None:
+            return
+        # selectors can't hold a socket with no events of interest
+        if not events:
+            self.reactor.unregister(self)
+        elif not self.events:
+            self.reactor.register(self, events)
+        else:
+            self.reactor.modify(self, events)
+        self.events = events
+
+    def handle_read_event(self):
+        if self.accepting:
+            self.handle_accept()
+        else:
+            self.handle_read()
+
+    def handle_write_event(self):
+        self.handle_write()
+
+    def handle_accept(self):
+        try:
+            sock, address = self.socket.accept()
+        except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+            return
+        self.handle_accepted(sock, address)
+
+    def handle_accepted(self, sock, address):
+        sock.close()
+
+    def handle_read(self):
+        pass
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        '''Called with the exception that escaped a handle_* method: log it
+        and close this dispatcher, leaving the rest of the loop running.'''
+        self.reactor.logger.exception("uncaptured python exception, closing "
+                                      "channel %r", self)
+        try:
+            self.handle_close()
+        except Exception:
+            self.reactor.logger.exception("uncaptured python exception while "
+                                          "closing channel %r", self)
+            self.close()
+
+    def send(self, data):
+        try:
+            return self.socket.send(data)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except OSError as err:
+            if err.errno in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    def sendmsg(self, buffers):
+        '''Gather write of a sequence of buffers in one system call.'''
+        try:
+            return self.socket.sendmsg(buffers)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except OSError as err:
+            if err.errno in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    def recv(self, buffer_size):
+        try:
+            data = self.socket.recv(buffer_size)
+        except (BlockingIOError, InterruptedError):
+            return b''
+        except OSError as err:
+            if err.errno in _DISCONNECTED:
+                self.handle_close()
+                return b''
+            raise
+        if not data:
+            self.handle_close()
+        return data
+
+    def recv_into(self, buffer):
+        '''Receive into a writable buffer, returns the number of bytes read.
+        A return of 0 without the dispatcher being closed means no data.'''
+        try:
+            received = self.socket.recv_into(buffer)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except OSError as err:
+            if err.errno in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+        if not received:
+            self.handle_close()
+        return received
+
+    def close(self):
+        if self.socket is None:
+            return
+        self.reactor.unregister(self)
+        try:
+            self.socket.close()
+        finally:
+            self.socket = None
+
+    def getsockname(self):
+        return self.socket.getsockname()
+
+    def getpeername(self):
+        return self.socket.getpeername()
+
+    def fileno(self):
+        return self.socket.fileno()
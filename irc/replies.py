@@ -0,0 +1,70 @@
+'''Numeric replies compiled for one server.
+
+Every entry of irc.IRC_CODE is turned into a Reply holding the encoded
+":<server> <code> " head, so sending a numeric only formats its text and
+joins a few bytes objects.  Replies without format arguments are encoded
+once, here.
+
+A sequence of replies to one client (a MOTD, a LIST) can be rendered with
+render_many into a single buffer and queued with one append.  Sequences that
+are the same for every client are pre-rendered once with block().
+'''
+import irc
+
+class Reply:
+    __slots__ = ('code', 'head', 'text', 'static')
+
+    def __init__(self, prefix, code, text):
+        self.code = code
+        self.head = ('%s %03d ' % (prefix, code)).encode()
+        self.text = text
+        # the encoded " <text>\r\n" tail when text takes no arguments
+        self.static = None
+        if '%(' not in text:
+            self.static = (' %s\r\n' % text.replace('%%', '%')).encode()
+
+    def render(self, nick, format_args):
+        if self.static is not None:
+            return b'%s%s%s' % (self.head, nick, self.static)
+        return b'%s%s %s\r\n' % (self.head, nick,
+                                 (self.text % format_args).encode())
+
+class ReplyTemplates:
+    def __init__(self, prefix):
+        self.templates = dict((code, Reply(prefix, code, text))
+                              for code, (name, text) in irc.IRC_CODE.items())
+
+    def render(self, nick, code, format_args):
+        '''Encoded reply line; nick is the target's nick as bytes.'''
+        return self.templates[code].render(nick, format_args)
+
+    def render_many(self, nick, replies):
+        '''Encode a sequence of (code, format_args) replies into one buffer.'''
+        templates = self.templates
+        return b''.join([templates[code].render(nick, format_args)
+                         for code, format_args in replies])
+
+    def block(self, replies):
+        '''Pre-render a sequence of (code, format_args) replies whose text
+        doesn't depend on the recipient, leaving only the nick to fill in.'''
+        pieces = []
+        tail = b''
+        for code, format_args in replies:
+            template = self.templates[code]
+            pieces.append(tail + template.head)
+            tail = template.render(b'', format_args)[len(template.head):]
+        pieces.append(tail)
+        return ReplyBlock(pieces)
+
+#
+# Replies rendered ahead of time.  The pieces are the bytes between each
+# occurrence of the recipient's nick, so rendering is one bytes.join.
+#
+class ReplyBlock:
+    __slots__ = ('pieces',)
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def render(self, nick):
+        return nick.join(self.pieces)
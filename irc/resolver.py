@@ -0,0 +1,85 @@
+import socket as _socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RESOLVER_THREADS = 4
+# seconds to remember a resolved name, and a failed lookup
+POSITIVE_TTL = 3600
+NEGATIVE_TTL = 300
+# expired entries are pruned once the cache grows past this many addresses
+CACHE_SIZE = 65536
+
+#
+# Reverse resolves client addresses without blocking the event loop.
+#
+# Lookups run on a small thread pool and the result is handed back to the
+# loop with Reactor.call_soon_threadsafe.  Names are only accepted if they
+# resolve forward to the same address again, and both answers and failures
+# are cached so a reconnecting client doesn't cost another lookup.
+#
+class Resolver:
+    def __init__(self, reactor, logger, threads=RESOLVER_THREADS,
+                 clock=time.monotonic):
+        self.reactor = reactor
+        self.logger = logger
+        self.clock = clock
+        # address -> (hostname, expires)
+        self.cache = dict()
+        # address -> callbacks waiting on a lookup in progress
+        self.waiting = dict()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.closed = False
+
+    def resolve(self, address, callback):
+        '''Call callback(hostname) from the event loop once address has been
+        resolved.  Called immediately on a cache hit.  hostname is the
+        address itself if it has no usable reverse record.'''
+        cached = self.cache.get(address)
+        if cached is not None and cached[1] > self.clock():
+            callback(cached[0])
+            return
+        if address in self.waiting:
+            self.waiting[address].append(callback)
+            return
+        self.waiting[address] = [callback]
+        self.executor.submit(self._lookup, address)
+
+    def _lookup(self, address):
+        # runs on a resolver thread
+        if self.closed:
+            return
+        try:
+            hostname = _socket.gethostbyaddr(address)[0]
+            forward = _socket.getaddrinfo(hostname, None)
+            if address not in [info[4][0] for info in forward]:
+                hostname = None
+        except (OSError, UnicodeError):
+            hostname = None
+        if not self.closed:
+            self.reactor.call_soon_threadsafe(self._resolved, address,
+                                              hostname)
+
+    def _resolved(self, address, hostname):
+        if len(self.cache) >= CACHE_SIZE:
+            self._prune()
+        if hostname is None:
+            self.cache[address] = (address, self.clock() + NEGATIVE_TTL)
+            hostname = address
+        else:
+            self.cache[address] = (hostname, self.clock() + POSITIVE_TTL)
+        self.logger.debug("Resolved %s to %s", address, hostname)
+        for callback in self.waiting.pop(address, ()):
+            callback(hostname)
+
+    def _prune(self):
+        now = self.clock()
+        for address, (hostname, expires) in list(self.cache.items()):
+            if expires <= now:
+                del self.cache[address]
+
+    def close(self):
+        '''Drop the lookups still queued and let the threads exit.  A lookup
+        already running finishes without reporting back.'''
+        self.closed = True
+        self.waiting.clear()
+        self.executor.shutdown(wait=False)
@@ -1,10 +1,14 @@
 from irc.channel import Channel
+from irc.client import whois_channels
+from irc.commands import command, dispatch_table
+import irc
 import re
 import pdb
 
 #
 # handles logic and stores data for connections to other servers in the network
 #
+@dispatch_table
 class IrcServer:
     hopcount = 1
     info = None
@@ -16,6 +20,7 @@ class IrcServer:
         self.server = server
         self.neighbors = dict()
 
+    @command(min_params=4)
     def cmd_server(self, prefix, args):
         '''Implements RFC 2813 section 4.1.2 for server topology notifications'''
         servername, hopcount, token, info = args
@@ -41,6 +46,7 @@ class IrcServer:
                 continue
             server.connection.raw_send(message)
 
+    @command(min_params=1)
     def cmd_join(self, prefix, args):
         # TODO
         # - netsplit on disagreements
@@ -54,14 +60,16 @@ class IrcServer:
         if client:
             channel.add(client)
 
+    @command(min_params=2)
     def cmd_privmsg(self, prefix, args):
         # TODO
         # - support modes other than sending to channel
-        channel, message = args
+        channel, message = args[:2]
         sender = self._client(prefix)
 
         self.server.channels[channel].privmsg(sender, message)
 
+    @command(min_params=1)
     def cmd_part(self, prefix, args):
         channel_name = args[0]
         if channel_name not in self.server.channels:
@@ -72,6 +80,7 @@ class IrcServer:
         if client:
             channel.remove(client)
 
+    @command(min_params=1)
     def cmd_nick(self, prefix, args):
         if len(args) == 1:
             # TODO: support nick changes too
@@ -84,11 +93,11 @@ class IrcServer:
             # FIXME: check for collisions and split if you get one
             self.server.clients[nickname] = client
 
+    @command()
     def cmd_quit(self, prefix, args):
-        match = re.match('[^!]+', prefix)
-        if match:
-            nick = match.group()
-            del self.server.clients[nick]
+        client = self._client(prefix)
+        if client:
+            self._remove_client(client, args[0] if args else None)
 
     def _client(self, prefix):
         match = re.match('[^!]+', prefix)
@@ -97,14 +106,17 @@ class IrcServer:
             return self.server.clients[nick]
 
     def cmd(self, prefix, command, args):
-        try:
-            cmd = getattr(self, 'cmd_%s' % command.lower())
-        except AttributeError as err:
-            self.server.logger.warning("Unimplemented command %s with args %s",
-                                       command,
-                                       args)
+        entry = self.COMMANDS.get(command)
+        if entry is None:
+            self.server.logger.debug("Unimplemented command %s from %s",
+                                     command, self.connection.nick)
+            return
+        if len(args) < entry.min_params:
+            self.server.logger.debug("Command %s from %s is missing " \
+                                     "parameters: %s",
+                                     command, self.connection.nick, args)
             return
-        cmd(prefix, args)
+        entry.handler(self, prefix, args)
 
     def notify_channel(self, channel_name, message, *format_args):
         # TODO
@@ -117,11 +129,32 @@ class IrcServer:
             for client in channel.clients:
                 client.connection.raw_send(('%s\r\n' % message) % format_args)
 
-    def netsplit(self, other):
-        for client in other.server.clients:
-            for quitting_client in self.server.clients:
-                client.raw_send('%s QUIT :%s %s' % (quitting_client.prefix(),
-                    other.server.name, self.server.name))
+    def netsplit(self):
+        '''Quit every client that was reached through this link.'''
+        tokens = {self.token}
+        tokens.update(neighbor.token for neighbor in self.neighbors.values())
+        reason = '%s %s' % (self.server.name, self.connection.nick)
+        for client in list(self.server.clients.values()):
+            if client.connection is None and client.servertoken() in tokens:
+                self._remove_client(client, reason)
+                # keep the nick for the client to come back to
+                self.server.delay_nick(client.nick())
+
+    def _remove_client(self, client, reason):
+        '''Drop a remote client, telling the local members of its channels.'''
+        if reason is None:
+            message = '%s QUIT\r\n' % client.prefix()
+        else:
+            message = '%s QUIT :%s\r\n' % (client.prefix(), reason)
+        data = message.encode()
+        recipients = set()
+        for channel in list(client.channels):
+            recipients |= channel.clients
+            channel.remove(client, parted = False)
+        for recipient in recipients:
+            if recipient.connection:
+                recipient.connection.queue(data)
+        self.server.clients.pop(client.nick(), None)
 
 # represents a server in the IRC Network
 class RemoteIrcServer:
@@ -142,6 +175,8 @@ class RemoteClient:
         self.mode = mode
         self.user = (username, host, realname)
         self.connection = None
+        self.channels = set()
+        self._prefix = ':%s!%s@%s' % (nick, username, host)
 
     def nick(self):
         return self.nickname
@@ -162,7 +197,10 @@ class RemoteClient:
         return self.server_token
 
     def prefix(self):
-        return ':%s!%s@%s' % (self.nick(), self.username(), self.host())
+        return self._prefix
+
+    def prefix_bytes(self):
+        return self._prefix.encode()
 
     def is_op(self):
         return self.mode.find("o") > -1
@@ -171,5 +209,9 @@ class RemoteClient:
         # TODO: move this junk somewhere so it can be shared with the irc/client
         # version
         requester.connection.reply(irc.RPL_WHOISUSER,
-                nick=self.nick, user=self.user[0], host=self.user[1],
-                realname=self.user[3])
+                nick=self.nick(), user=self.username(), host=self.host(),
+                realname=self.realname())
+        if self.channels:
+            requester.connection.reply(irc.RPL_WHOISCHANNELS,
+                    nick=self.nick(), channels=whois_channels(self))
+        requester.connection.reply(irc.RPL_ENDOFWHOIS)
@@ -1,31 +1,202 @@
 import time
+from array import array
 
+# the STATS t / STATS m view: the last MAX_SAMPLE_POINTS complete periods of
+# MIN_SAMPLE_PERIOD seconds
 MIN_SAMPLE_PERIOD = 5
 MAX_SAMPLE_POINTS = 10
 
+# (name, seconds per point, points kept) of each resolution
+RESOLUTIONS = (
+    ('1s', 1, 300),
+    ('1m', 60, 180),
+    ('1h', 3600, 168),
+)
+
+# largest value an array('q') point can hold
+MAX_POINT = 2 ** 63 - 1
+
+# latency histogram bucket b counts times of 2**(b-1) up to 2**b nanoseconds,
+# the last bucket everything slower
+LATENCY_BUCKETS = 40
+# name commands outside the known set are counted under
+UNKNOWN_COMMAND = 'UNKNOWN'
+
+#
+# Fixed size ring of points, one per `step` seconds.  Each slot remembers the
+# period it holds, so slots left over from an earlier turn of the ring read
+# as zero and never need clearing.
+#
+class Series:
+    __slots__ = ('step', 'size', 'values', 'periods', 'latest')
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.values = array('q', bytes(8 * size))
+        self.periods = array('q', [-1]) * size
+        # the newest period written
+        self.latest = -1
+
+    def add(self, period, amount):
+        '''Add amount to the point of period, returning a drop reason if it
+        couldn't be recorded.'''
+        if period <= self.latest - self.size:
+            return 'expired'
+        slot = period % self.size
+        if self.periods[slot] != period:
+            self.periods[slot] = period
+            self.values[slot] = 0
+        value = self.values[slot] + amount
+        if value > MAX_POINT:
+            self.values[slot] = MAX_POINT
+            return 'overflow'
+        self.values[slot] = value
+        if period > self.latest:
+            self.latest = period
+        return None
+
+    def get(self, period):
+        slot = period % self.size
+        if self.periods[slot] != period:
+            return 0
+        return self.values[slot]
+
+    def points(self, end, count):
+        '''(amount, timestamp) of the count periods before period end, oldest
+        first, each stamped with the time it ended.'''
+        count = min(count, self.size)
+        return [(self.get(period), (period + 1) * self.step)
+                for period in range(end - count, end)]
+
+#
+# Counts an amount (bytes, messages) over time.  record() is called on every
+# send and receive, so it only adds to an accumulator; the accumulated second
+# is rolled into the 1s, 1m and 1h series when the clock moves on, which is
+# at most once a second.  clock is expected to be cheap, such as the time
+# cached by the reactor on each pass of the loop.
+#
+# Points that can't be recorded are counted by reason in `dropped`:
+#   negative         record() was given a negative amount
+#   expired          the clock went back further than a series reaches
+#   overflow         a point reached MAX_POINT
+#
 class Statistic:
-    def __init__(self):
-        self.data = list()
-        self.expires = time.time() + MIN_SAMPLE_PERIOD
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.series = dict((name, Series(step, size))
+                           for name, step, size in RESOLUTIONS)
+        self._rollups = [(series.step, series)
+                         for series in self.series.values()]
         self.accumulator = 0
+        self.second = int(clock())
+        self.dropped = dict()
+        self.total = 0
 
     def record(self, amount):
+        if self.clock() >= self.second + 1:
+            self.check()
+        if amount < 0:
+            self.drop('negative')
+            return
         self.accumulator += amount
-        self.check()
 
     def check(self):
-        now = time.time()
-        if now >= self.expires:
-            point = (self.accumulator, int(now))
-            self.data.append(point)
-            self.data = self.data[-MAX_SAMPLE_POINTS:]
-            self.expires = now + MIN_SAMPLE_PERIOD
-            self.accumulator = 0
+        '''Roll the accumulated amount up if its second has passed.'''
+        now = int(self.clock())
+        if now == self.second:
+            return
+        amount = self.accumulator
+        if amount:
+            self.total += amount
+            for step, series in self._rollups:
+                reason = series.add(self.second // step, amount)
+                if reason is not None:
+                    self.drop(reason)
+        self.accumulator = 0
+        self.second = now
+
+    def drop(self, reason):
+        self.dropped[reason] = self.dropped.get(reason, 0) + 1
+
+    def points(self, resolution='1s', count=None):
+        '''Complete (amount, timestamp) points of a resolution, oldest
+        first.'''
+        self.check()
+        series = self.series[resolution]
+        if count is None:
+            count = series.size
+        return series.points(self.second // series.step, count)
 
     def __str__(self):
+        # the last complete MIN_SAMPLE_PERIOD windows, summed from 1s points
         self.check()
-        points = ["%x,%x" % x for x in self.data]
+        seconds = self.series['1s']
+        end = self.second - self.second % MIN_SAMPLE_PERIOD
+        points = []
+        for window in range(end - MIN_SAMPLE_PERIOD * MAX_SAMPLE_POINTS, end,
+                            MIN_SAMPLE_PERIOD):
+            amount = sum(seconds.get(second) for second
+                         in range(window, window + MIN_SAMPLE_PERIOD))
+            points.append("%x,%x" % (amount, window + MIN_SAMPLE_PERIOD))
         return " ".join(points)
 
+#
+# Calls, bytes received and a log2 latency histogram for one command.
+#
+class CommandStatistic:
+    __slots__ = ('count', 'remote', 'bytes', 'elapsed', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.remote = 0
+        self.bytes = 0
+        # total nanoseconds spent
+        self.elapsed = 0
+        self.histogram = array('q', bytes(8 * LATENCY_BUCKETS))
+
+    def percentile(self, fraction):
+        '''Upper bound, in nanoseconds, of the latency below which fraction
+        of the calls completed.'''
+        calls = self.count + self.remote
+        if not calls:
+            return 0
+        wanted = fraction * calls
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= wanted:
+                return 2 ** bucket
+        return 2 ** (LATENCY_BUCKETS - 1)
+
+#
+# CommandStatistic for each command dispatched.  Commands not in `known`
+# share one entry, so garbage from clients can't grow the table.
+#
+class CommandStatistics:
+    def __init__(self, known):
+        self.known = frozenset(known)
+        self.commands = dict()
+
+    def record(self, command, size, elapsed, remote=False):
+        '''Count a command that took elapsed nanoseconds to handle.'''
+        if command not in self.known:
+            command = UNKNOWN_COMMAND
+        entry = self.commands.get(command)
+        if entry is None:
+            entry = self.commands[command] = CommandStatistic()
+        if remote:
+            entry.remote += 1
+        else:
+            entry.count += 1
+        entry.bytes += size
+        entry.elapsed += elapsed
+        entry.histogram[min(elapsed.bit_length(), LATENCY_BUCKETS - 1)] += 1
+
+    def busiest(self):
+        '''(command, CommandStatistic) pairs, most time spent first.'''
+        return sorted(self.commands.items(),
+                      key=lambda item: item[1].elapsed, reverse=True)
+
 class StatisticCollection:
     pass
@@ -0,0 +1,241 @@
+'''Time series of the server's statistics, kept in SQLite for the dashboard.
+
+Every FLUSH_INTERVAL seconds the recorder takes the complete one second
+points of each Statistic since its last flush, sums them into
+RAW_STEP windows and queues them, along with the current gauges (users,
+channels, ...), for a writer thread that commits each flush in one
+transaction.  The same values are added into the 1m, 1h and 1d rollup
+tables, so a query over a month reads a few hundred rows instead of every
+sample, and old rows are pruned per TABLES.  When MAX_QUEUE flushes are
+waiting on the database, further ones are dropped rather than holding up
+the server.
+
+Tables, all keyed by (statistic, timestamp, worker), timestamp being the
+end of the period in seconds since the epoch:
+    samples_raw, samples_1m, samples_1h, samples_1d
+    topology        the server names linked at each flush, keyed by
+                    timestamp alone
+Each worker process writes its own rows; readers sum them per timestamp:
+    SELECT timestamp, sum(value) FROM samples_1m WHERE statistic = ?
+    GROUP BY timestamp
+'''
+import json
+import logging
+import queue
+import sqlite3
+import threading
+
+FLUSH_INTERVAL = 10
+# seconds per raw sample
+RAW_STEP = 10
+# (table, seconds per row, seconds kept or None to keep forever)
+TABLES = (
+    ('samples_raw', RAW_STEP, 86400),
+    ('samples_1m', 60, 7 * 86400),
+    ('samples_1h', 3600, 90 * 86400),
+    ('samples_1d', 86400, None),
+)
+# seconds between pruning runs
+PRUNE_INTERVAL = 3600
+# flushes waiting for the writer before new ones are dropped
+MAX_QUEUE = 100
+# longest flush interval the 1s series can cover without losing points
+MAX_INTERVAL = 240
+# statistics (StatisticCollection attributes) summed into each period
+COUNTERS = ('sent', 'received', 'messages')
+logger = logging.getLogger('irked')
+
+def gauges(server):
+    '''Values sampled at each flush; rollups keep each worker's maximum
+    over the period.'''
+    return {
+        'users' : len(server.clients),
+        'channels' : len(server.channels),
+        'connections' : len(server.connections),
+        # this process's own links, which add up over workers
+        'links' : len(server.servers),
+    }
+
+#
+# Samples the server's statistics from the event loop and hands them to a
+# StatsWriter.  The database is in WAL mode, so the dashboard reads while a
+# flush writes.  Worker processes may share the file, each writing rows of
+# its own worker number.
+#
+class StatsRecorder:
+    def __init__(self, server, path, interval=FLUSH_INTERVAL, worker=0):
+        self.server = server
+        self.path = path
+        self.worker = worker
+        self.interval = min(interval, MAX_INTERVAL)
+        # the tables are created here so a bad path fails at startup
+        db = connect(path)
+        try:
+            create_tables(db)
+        finally:
+            db.close()
+        # start of the first window not yet written, for each counter
+        now = int(server.reactor.cached_time())
+        self.flushed = dict((name, now - now % RAW_STEP) for name in COUNTERS)
+        self.pruned = 0
+        self.writer = StatsWriter(path)
+        self.writer.start()
+        server.reactor.call_later(self.interval, self.flush)
+
+    def flush(self):
+        self.server.reactor.call_later(self.interval, self.flush)
+        self.writer.put(self.sample())
+
+    def sample(self):
+        '''The rows of one flush: (counters, gauges, timestamp, servers,
+        statistics to prune or None).'''
+        now = int(self.server.reactor.cached_time())
+        counters = []
+        for name in COUNTERS:
+            counters.extend(self.windows(name, now))
+        # gauges are stamped like the last complete counter window, so every
+        # worker's samples of a window share a timestamp
+        end = now - now % RAW_STEP
+        sampled = [(name, end, value)
+                   for name, value in gauges(self.server).items()]
+        servers = json.dumps([self.server.name] + list(self.server.servers))
+        prune = None
+        if now - self.pruned >= PRUNE_INTERVAL:
+            prune = list(COUNTERS) + [name for name, end, value in sampled]
+            self.pruned = now
+        return (rollups(counters, self.worker), rollups(sampled, self.worker),
+                end, servers, prune)
+
+    def close(self):
+        '''Write the windows completed since the last flush and wait for the
+        writer to finish.'''
+        self.writer.put(self.sample())
+        self.writer.stop()
+
+    def windows(self, name, now):
+        '''(name, end, amount) of each complete RAW_STEP window of statistic
+        name not written yet.'''
+        statistic = getattr(self.server.statistics, name)
+        end = now - now % RAW_STEP
+        start = self.flushed[name]
+        self.flushed[name] = end
+        amounts = dict()
+        for amount, timestamp in statistic.points('1s'):
+            # points are stamped with the end of their second
+            second = timestamp - 1
+            if start <= second < end and amount:
+                window = second - second % RAW_STEP + RAW_STEP
+                amounts[window] = amounts.get(window, 0) + amount
+        return [(name, window, amount)
+                for window, amount in sorted(amounts.items())]
+
+#
+# Thread owning the database connection.  Flushes arrive through a bounded
+# queue; None asks the thread to write what is left and exit.
+#
+class StatsWriter(threading.Thread):
+    def __init__(self, path, max_queue=MAX_QUEUE):
+        threading.Thread.__init__(self, name='statsdb', daemon=True)
+        self.path = path
+        self.flushes = queue.Queue(max_queue)
+        self.dropped = 0
+
+    def put(self, flush):
+        '''Queue a flush from the event loop, without ever blocking.'''
+        try:
+            self.flushes.put_nowait(flush)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("statistics queue full, %d flushes dropped",
+                           self.dropped)
+
+    def run(self):
+        db = connect(self.path)
+        try:
+            while True:
+                flush = self.flushes.get()
+                if flush is None:
+                    break
+                try:
+                    self.write(db, *flush)
+                except sqlite3.Error as err:
+                    logger.error("Unable to record statistics in %s: %s",
+                                 self.path, err)
+        finally:
+            db.close()
+
+    def write(self, db, counters, sampled, end, servers, prune):
+        with db:
+            for table, step, retention in TABLES:
+                db.executemany(
+                    'INSERT INTO %s VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (statistic, timestamp, worker) '
+                    'DO UPDATE SET value = value + excluded.value' % table,
+                    counters[table])
+                db.executemany(
+                    'INSERT INTO %s VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (statistic, timestamp, worker) '
+                    'DO UPDATE SET value = max(value, excluded.value)' % table,
+                    sampled[table])
+            db.execute('INSERT OR REPLACE INTO topology VALUES (?, ?)',
+                       (end, servers))
+            if prune is not None:
+                self.prune(db, end, prune)
+
+    def prune(self, db, now, statistics):
+        for table, step, retention in TABLES:
+            if retention is None:
+                continue
+            db.executemany(
+                'DELETE FROM %s WHERE statistic = ? AND timestamp < ?' % table,
+                [(name, now - retention) for name in statistics])
+        db.execute('DELETE FROM topology WHERE timestamp < ?',
+                   (now - TABLES[0][2],))
+
+    def stop(self, timeout=5):
+        '''Write the flushes still queued and wait for the thread to finish,
+        giving up after timeout seconds if it is stuck.'''
+        if not self.is_alive():
+            return
+        try:
+            self.flushes.put(None, timeout=timeout)
+        except queue.Full:
+            logger.error("statistics writer is not draining, giving up")
+            return
+        self.join(timeout)
+
+def connect(path):
+    # a flush waits at most this long for another worker's
+    db = sqlite3.connect(path, timeout=5)
+    db.execute('PRAGMA journal_mode=WAL')
+    # WAL only needs to sync on checkpoints to stay consistent
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+def create_tables(db):
+    with db:
+        for table, step, retention in TABLES:
+            db.execute('CREATE TABLE IF NOT EXISTS %s ('
+                       'statistic TEXT NOT NULL, '
+                       'timestamp INTEGER NOT NULL, '
+                       'worker INTEGER NOT NULL, '
+                       'value INTEGER NOT NULL, '
+                       'PRIMARY KEY (statistic, timestamp, worker)'
+                       ') WITHOUT ROWID' % table)
+        # not "servers", which the old harvester left behind with another
+        # layout
+        db.execute('CREATE TABLE IF NOT EXISTS topology ('
+                   'timestamp INTEGER PRIMARY KEY, '
+                   'servers TEXT)')
+
+def rollups(samples, worker):
+    '''Rows of samples for each table in TABLES, by table name.'''
+    return dict((table, rollup(samples, step, worker))
+                for table, step, retention in TABLES)
+
+def rollup(samples, step, worker):
+    '''(name, end of the step long period, worker, value) rows of (name,
+    timestamp, value) samples.'''
+    return [(name, timestamp - (timestamp - 1) % step - 1 + step, worker,
+             value)
+            for name, timestamp, value in samples]
@@ -0,0 +1,56 @@
+import os
+import time
+
+# seconds between checks of a file's modification time
+CHECK_INTERVAL = 2
+
+#
+# The lines of a small text file (the MOTD, the INFO text), kept in memory.
+#
+# The file is read again only when its modification time changes, and the
+# modification time is looked at no more than once per CHECK_INTERVAL, so
+# serving the text to many connecting clients costs no disk access.  `serial`
+# changes on every reload, letting callers cache anything rendered from it.
+#
+class TextFile:
+    def __init__(self, path, clock=time.monotonic):
+        self.path = path
+        self.clock = clock
+        self.lines = None
+        self.mtime = None
+        self.serial = 0
+        self.checked = None
+
+    def get(self):
+        '''The file's lines without line endings, or None if it can't be
+        read.'''
+        now = self.clock()
+        if self.checked is None or now - self.checked >= CHECK_INTERVAL:
+            self.checked = now
+            self._check()
+        return self.lines
+
+    def reload(self):
+        '''Forget the cached contents; the file is read on the next get().'''
+        self.checked = None
+        self.mtime = None
+        self.lines = None
+        self.serial += 1
+
+    def _check(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        lines = None
+        if mtime is not None:
+            try:
+                with open(self.path) as text:
+                    lines = tuple(line.rstrip() for line in text)
+            except OSError:
+                mtime = None
+        self.mtime = mtime
+        self.lines = lines
+        self.serial += 1
@@ -0,0 +1,93 @@
+import time
+
+# seconds per slot, and slots per turn of the wheel
+WHEEL_TICK = 1.0
+WHEEL_SIZE = 512
+
+#
+# Hashed timing wheel for the many coarse, usually cancelled timers a server
+# keeps: keepalive PINGs, registration timeouts and nick delays.
+#
+# Timers are keyed (by the connection, or ("nick", name)) and each key has at
+# most one timer, so rescheduling just replaces it.  A timer goes into the
+# slot it expires in, counting whole turns of the wheel in `rounds`, which
+# makes schedule, cancel and expiry O(1) regardless of how many timers are
+# pending.  The reactor calls advance() as the clock passes each tick.
+#
+class TimingWheel:
+    def __init__(self, tick=WHEEL_TICK, size=WHEEL_SIZE, clock=time.monotonic,
+                 run=None):
+        self.tick = tick
+        self.size = size
+        self.clock = clock
+        # run(callback, args) calls an expired timer, the reactor's catches
+        # and logs what it raises
+        self.run = run or (lambda callback, args: callback(*args))
+        # slot -> {key: (rounds, callback, args)}
+        self.slots = [dict() for i in range(size)]
+        # key -> slot holding its timer
+        self.where = dict()
+        # ticks processed so far, and when the next one is due
+        self.ticks = 0
+        self.next_tick = clock() + tick
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, delay, callback, *args):
+        '''Call callback(*args) from the loop in about delay seconds (rounded
+        up to the next tick), replacing key's previous timer, if any.'''
+        self.cancel(key)
+        if not self.where:
+            # catch up on the ticks that passed while nothing was pending
+            self.advance()
+        # the slot of the tick in progress is processed at next_tick, count
+        # whole ticks from there
+        ticks = max(0, int(-(-(self.clock() + delay - self.next_tick) //
+                             self.tick)))
+        slot = (self.ticks + ticks) % self.size
+        self.slots[slot][key] = (ticks // self.size, callback, args)
+        self.where[key] = slot
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def timeout(self):
+        '''Seconds until the loop next needs to call advance(), None if no
+        timers are pending.'''
+        if not self.where:
+            return None
+        return max(0, self.next_tick - self.clock())
+
+    def advance(self):
+        '''Run the timers of every tick that has passed.'''
+        now = self.clock()
+        if not self.where and self.next_tick <= now:
+            # nothing pending, skip ahead instead of walking empty slots
+            skipped = int((now - self.next_tick) // self.tick) + 1
+            self.ticks += skipped
+            self.next_tick += skipped * self.tick
+            return
+        while self.next_tick <= now:
+            self._expire(self.ticks % self.size)
+            self.ticks += 1
+            self.next_tick += self.tick
+
+    def _expire(self, slot):
+        timers = self.slots[slot]
+        if not timers:
+            return
+        expired = []
+        for key, (rounds, callback, args) in timers.items():
+            if rounds:
+                timers[key] = (rounds - 1, callback, args)
+            else:
+                expired.append((key, callback, args))
+        for key, callback, args in expired:
+            del timers[key]
+            del self.where[key]
+        # callbacks may schedule new timers, even into this slot
+        for key, callback, args in expired:
+            self.run(callback, args)
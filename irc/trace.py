@@ -0,0 +1,30 @@
+'''Protocol tracing.
+
+Lines received from and sent to connections can be logged to the
+"irked.trace" logger, which is switched on separately from normal logging
+([log] trace = yes).  The hot paths check the module level ENABLED flag
+before doing any formatting at all:
+
+    if trace.ENABLED:
+        trace.sent(self.nick, message)
+'''
+import logging
+
+ENABLED = False
+logger = logging.getLogger('irked.trace')
+
+def enable(handler):
+    '''Turn tracing on, writing records through handler.'''
+    global ENABLED
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+    ENABLED = True
+
+def received(nick, line):
+    logger.debug("<< %s: %s", nick, line)
+
+def sent(nick, line):
+    if isinstance(line, bytes):
+        line = bytes.decode(line, errors='replace')
+    logger.debug(">> %s: %s", nick, line.rstrip('\r\n'))
@@ -16,68 +16,98 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asyncore
 import logging
 import socket as _socket
 import re
 import irc
+import irc.trace as trace
 import time
-import subprocess
 import os.path
 import argparse
 import configparser
 import sys
 import random
 import hashlib
+import heapq
+import signal
+import sqlite3
 from irc.client import IrcClient
 from irc.server import IrcServer
 from irc.channel import Channel
-from irc.handler import IrcHandler
+from irc.handler import IrcHandler, DEFAULT_SENDQ, DEFAULT_DRAIN_TIMEOUT, \
+    DEFAULT_REGISTRATION_TIMEOUT, DEFAULT_PING_INTERVAL, DEFAULT_PING_TIMEOUT
+from irc.reactor import Reactor, Dispatcher
+from irc.resolver import Resolver
 from irc.extensions import IrcExtensions
-from irc.statistics import Statistic, StatisticCollection
+from irc.statistics import Statistic, StatisticCollection, CommandStatistics
+from irc.framer import DEFAULT_RECVQ
+from irc.log import queue_handler, stop_listeners, SamplingFilter, PhaseTimer
+from irc.replies import ReplyTemplates
+from irc.textfile import TextFile
+from irc.metrics import MetricsListener, LoopLagMonitor, DEFAULT_METRICS_HOST
+from irc.statsdb import StatsRecorder, FLUSH_INTERVAL
+from irc.flood import FloodPolicy, FLOOD_WINDOW, DEFAULT_COST, MAX_DEFERRED, \
+    EXCESS_DISCONNECT
 
 MOTD_FILE = "motd"
 INFO_FILE = "info"
 CONFIG_FILE = 'irked.conf'
+# written by mkversion.py
+VERSION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'VERSION')
 
 LOG_FILE = "irked.log"
 LOG_FORMAT = "%(asctime)s %(filename)s:" + \
     "%(lineno)d in %(funcName)s %(levelname)s: %(message)s"
-LOG_LEVEL = logging.DEBUG
+LOG_LEVEL = logging.INFO
 LOGGER = "irked"
+TRACE_FILE = "irked.trace.log"
+# at most LOG_SAMPLE_BURST messages from one logging call per interval
+LOG_SAMPLE_INTERVAL = 10
+LOG_SAMPLE_BURST = 20
 
 DEFAULT_HOST = ''
 DEFAULT_PORT = 6667
 DEFAULT_NAME = 'irked.server'
+# seconds the nicks of clients lost in a netsplit stay reserved
+DEFAULT_NICK_DELAY = 1800
 
 #
 # The dispatcher is responsible for setting up a socket for IRC connections and
 # spawning appropriate handlers for incoming connections (either IrcClient or
 # IrcServer
 #
-# Sockets are polled by asyncore.  It fires callback methods on the handlers
-# when data is availabe for reading
+# Sockets are polled by the reactor (epoll where available).  It fires callback
+# methods on the handlers when data is availabe for reading, and when a handler
+# with queued output becomes writable
 #
-class IrcDispatcher(asyncore.dispatcher):
+class IrcDispatcher(Dispatcher):
 
     def __init__(self, host=None, port=None, name=None, config=CONFIG_FILE):
+        boot = PhaseTimer()
         self.config_file = config
         self.config = configparser.ConfigParser()
         self.config.read(self.config_file)
+        boot.mark('config')
         self.init_logger()
-        self.setup_extensions()
+        boot.mark('logging')
         self.server_config(host, port, name)
+        self.extensions = IrcExtensions(self.logger)
+        boot.mark('setup')
 
-        asyncore.dispatcher.__init__(self)
+        Dispatcher.__init__(self, Reactor(logger=self.logger))
         self.create_socket(_socket.AF_INET, _socket.SOCK_STREAM)
         self.set_reuse_addr()
         self.bind(self.address)
-        self.listen(5)
+        self.listen(_socket.SOMAXCONN)
         self.logger.info('Bound to "%s", listening on port %d' % self.address)
+        boot.mark('bind')
 
         self.token = random.randint(1, 1000)
         self.connections = set()
-        self.clients = dict()
+        # nick -> IrcClient or RemoteClient, matched case insensitively like
+        # channel members
+        self.clients = irc.IrcDict()
         self.servers = dict()
         self.services = dict()
         self.channels = dict()
@@ -88,19 +118,35 @@ class IrcDispatcher(asyncore.dispatcher):
         for i in irc.IRC_CHANNEL_MODES:
             self.channel_modes[i] = True
 
-        self.version = self.gen_version()
+        self.resolver = None
+        if self.config.getboolean('server', 'resolve_hosts', fallback=True):
+            self.resolver = Resolver(self.reactor, self.logger)
+
+        self.setup_metrics()
+
+        self.version = self.read_version()
         self.version_comment = 'Development'
 
         self.statistics = StatisticCollection()
-        self.statistics.sent = Statistic()
-        self.statistics.received = Statistic()
-        self.statistics.messages = Statistic()
+        self.statistics.sent = Statistic(self.reactor.cached_time)
+        self.statistics.received = Statistic(self.reactor.cached_time)
+        self.statistics.messages = Statistic(self.reactor.cached_time)
+        self.statistics.commands = CommandStatistics(
+            set(IrcHandler.COMMANDS) | set(IrcClient.COMMANDS) |
+            set(IrcServer.COMMANDS))
+        self.setup_stats_db()
 
         self.launched = time.strftime("%c %Z")
+        boot.mark('state')
         self.logger.info('Server %s running irked version %s launched on %s',
                          self.name,
                          self.version,
                          self.launched)
+        self.logger.info('Ready to accept connections in %s', boot)
+
+        # extensions are loaded from the event loop, one per pass, so
+        # connections are accepted while they import
+        self.reactor.call_soon(self.setup_extensions, PhaseTimer())
 
     def server_config(self, host, port, name):
         if host is None:
@@ -112,9 +158,51 @@ class IrcDispatcher(asyncore.dispatcher):
         if name is None:
             name = self.config.get('server', 'name', fallback=DEFAULT_NAME)
         self.name = name
+        self.replies = ReplyTemplates(self.prefix())
+
+        self.recvq = self.config.getint('server', 'recvq', fallback=DEFAULT_RECVQ)
+        self.sendq = dict((sendq_class, self.config.getint('sendq', sendq_class,
+                                                           fallback=limit))
+                          for sendq_class, limit in DEFAULT_SENDQ.items())
+        self.sendq_min = min(self.sendq.values())
+        self.drain_timeout = self.config.getfloat('server', 'drain_timeout',
+                                                  fallback=DEFAULT_DRAIN_TIMEOUT)
+        self.registration_timeout = self.config.getfloat(
+            'server', 'registration_timeout',
+            fallback=DEFAULT_REGISTRATION_TIMEOUT)
+        self.ping_interval = self.config.getfloat('server', 'ping_interval',
+                                                  fallback=DEFAULT_PING_INTERVAL)
+        self.ping_timeout = self.config.getfloat('server', 'ping_timeout',
+                                                 fallback=DEFAULT_PING_TIMEOUT)
+        self.nick_delay = self.config.getfloat('server', 'nick_delay',
+                                               fallback=DEFAULT_NICK_DELAY)
+        # irc_lower()ed nicks reserved by delay_nick
+        self.delayed_nicks = set()
+
+        self.flood = None
+        if self.config.getboolean('flood', 'enabled', fallback=True):
+            costs = dict()
+            if self.config.has_section('flood_costs'):
+                costs = dict((command.upper(), float(cost)) for command, cost
+                             in self.config.items('flood_costs'))
+            self.flood = FloodPolicy(
+                window=self.config.getfloat('flood', 'window',
+                                            fallback=FLOOD_WINDOW),
+                default_cost=self.config.getfloat('flood', 'cost',
+                                                  fallback=DEFAULT_COST),
+                costs=costs,
+                max_deferred=self.config.getint('flood', 'max_deferred',
+                                                fallback=MAX_DEFERRED),
+                excess=self.config.get('flood', 'excess',
+                                       fallback=EXCESS_DISCONNECT))
 
         self.motd_file = self.config.get('server', 'motd_file', fallback=MOTD_FILE)
         self.info_file = self.config.get('server', 'info_file', fallback=INFO_FILE)
+        self.motd_text = TextFile(self.motd_file)
+        self.info_text = TextFile(self.info_file)
+        # (TextFile.serial, ReplyBlock) rendered from the text
+        self._motd_block = (None, None)
+        self._info_block = (None, None)
 
     def init_logger(self):
         log_file = self.config.get("log", "log_file", fallback=LOG_FILE)
@@ -127,33 +215,93 @@ class IrcDispatcher(asyncore.dispatcher):
         else:
             log_level = LOG_LEVEL
 
+        sample_interval = self.config.getfloat("log", "sample_interval",
+                                               fallback=LOG_SAMPLE_INTERVAL)
+        sample_burst = self.config.getint("log", "sample_burst",
+                                          fallback=LOG_SAMPLE_BURST)
+
         self.logger = logging.getLogger(LOGGER)
         self.logger.setLevel(log_level)
-        file_handler = logging.FileHandler(log_file)
         formatter = logging.Formatter(LOG_FORMAT)
+        file_handler = logging.FileHandler(log_file)
         file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+        handler = queue_handler(file_handler)
+        handler.addFilter(SamplingFilter(sample_interval, sample_burst))
+        self.logger.addHandler(handler)
         self.logger.info("Initialized logger %s at level %d to file %s.",
                          LOGGER,
                          log_level,
                          log_file)
 
-    def setup_extensions(self):
-        self.extensions = IrcExtensions(self.logger);
+        if self.config.getboolean("log", "trace", fallback=False):
+            trace_file = self.config.get("log", "trace_file",
+                                         fallback=TRACE_FILE)
+            trace_handler = logging.FileHandler(trace_file)
+            trace_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            trace.enable(queue_handler(trace_handler))
+            self.logger.info("Protocol trace enabled to file %s.", trace_file)
+
+    def setup_metrics(self):
+        '''Start the HTTP metrics listener if [metrics] port is set.'''
+        self.metrics = None
+        self.loop_lag = None
+        port = self.config.getint('metrics', 'port', fallback=None)
+        if port is None:
+            return
+        host = self.config.get('metrics', 'host', fallback=DEFAULT_METRICS_HOST)
+        self.loop_lag = LoopLagMonitor(self.reactor)
+        try:
+            self.metrics = MetricsListener(self, (host, port))
+        except OSError as err:
+            self.logger.error('Unable to serve metrics on %s:%d: %s',
+                              host, port, err)
+            return
+        self.logger.info('Serving metrics on http://%s:%d/metrics',
+                         host, port)
+
+    def setup_stats_db(self):
+        '''Record statistics for the dashboard if [stats] db is set.'''
+        self.stats_db = None
+        path = self.config.get('stats', 'db', fallback=None)
+        if path is None:
+            return
+        interval = self.config.getfloat('stats', 'interval',
+                                        fallback=FLUSH_INTERVAL)
+        try:
+            self.stats_db = StatsRecorder(self, path, interval)
+        except sqlite3.Error as err:
+            self.logger.error('Unable to record statistics in %s: %s',
+                              path, err)
+            return
+        self.logger.info('Recording statistics in %s', path)
+
+    def setup_extensions(self, timer):
         try:
             load = self.config['extensions']
         except KeyError:
             self.logger.warning("No extensions configuration section. No extensions loaded.")
             return
-        for name, location in load.items():
-            self.logger.debug("Loading extension '%s'", name)
-            try:
-                options = self.config[name]
-            except KeyError as err:
-                self.logger.warning("No extension configuration for '%s'", name)
-                options = dict()
+        self.load_extensions(timer, list(load.items()))
+
+    def load_extensions(self, timer, pending):
+        if not pending:
+            self.logger.info("Loaded extensions: [%s] in %s",
+                             ", ".join(self.extensions.modules.keys()), timer)
+            return
+        name, location = pending.pop(0)
+        self.logger.debug("Loading extension '%s'", name)
+        try:
+            options = self.config[name]
+        except KeyError as err:
+            self.logger.warning("No extension configuration for '%s'", name)
+            options = dict()
+        # the rest still load if this one fails
+        self.reactor.call_soon(self.load_extensions, timer, pending)
+        try:
             self.extensions.register(name, location, options)
-        self.logger.info("Loaded extensions: [%s]", ", ".join(self.extensions.modules.keys()))
+        except Exception:
+            self.logger.exception("Unable to load extension '%s'", name)
+        timer.mark(name)
 
     def sconnect(self, server, port):
         socket = _socket.socket(_socket.AF_INET, _socket.SOCK_STREAM)
@@ -175,20 +323,18 @@ class IrcDispatcher(asyncore.dispatcher):
     def squit(self, server, comment):
         handler = self.servers[server]
         try:
-            handler.connection.close()
+            handler.connection.close_when_done()
         except Exception as err:
             self.logger.error("Exception during socket close: %s" % \
                                   err)
         finally:
-            for neighbor in self.servers:
-                neighbor.netsplit(server)
+            handler.netsplit()
             del self.servers[server]
 
     def channel_add(self, channel, owner):
         self.extensions.pre_channel_create(channel);
         self.channels[channel] = Channel(channel, self)
         self.channels[channel].modes.creator = owner
-        self.channels[channel].modes.operators.add(owner)
 
     def handle_accepted(self, socket, port):
         self.logger.info('Yay, connection from %s', repr(port))
@@ -200,17 +346,36 @@ class IrcDispatcher(asyncore.dispatcher):
 
         # TODO: check that the sender has permission to send messages here
 
-        prefixed_message = '%s %s\r\n' % (sender.prefix(), message)
+        data = b'%s %s\r\n' % (sender.prefix_bytes(), message.encode())
+        if trace.ENABLED:
+            trace.sent(channel, data)
         for client in self.channels[channel].clients:
             if client == sender and not notify_sender:
                 continue
             if not client.connection:
                 continue
-            client.connection.raw_send(prefixed_message)
+            client.connection.queue(data)
         for server in self.servers.items():
             if sender.servertoken() == server.token:
                 continue
-            server.connection.raw_send(prefixed_message)
+            server.connection.queue(data)
+
+    def delay_nick(self, nick):
+        '''Keep nick from being taken for the nick_delay period.'''
+        if not self.nick_delay:
+            return
+        name = irc.irc_lower(nick)
+        self.delayed_nicks.add(name)
+        self.reactor.wheel.schedule(('nick', name), self.nick_delay,
+                                    self.delayed_nicks.discard, name)
+
+    def nick_delayed(self, nick):
+        return irc.irc_lower(nick) in self.delayed_nicks
+
+    def sendq_consumers(self, count):
+        '''The count connections with the most output queued.'''
+        return heapq.nlargest(count, self.connections,
+                              key=lambda connection: connection.out_size)
 
     def prefix(self):
         # FIXME
@@ -222,36 +387,66 @@ class IrcDispatcher(asyncore.dispatcher):
              repr(self.clients.keys()),
              repr(self.channels))
 
-    def gen_version(self):
-        '''Fetch the current revision number for the working directory for
-        use as a version number'''
+    def read_version(self):
+        '''Read the version number generated by mkversion.py.'''
+        version_file = self.config.get('server', 'version_file',
+                                       fallback=VERSION_FILE)
         try:
-            branch = subprocess.check_output(["hg", "branch"])
-            command = ["hg", "heads",
-                       branch.strip(),
-                        "--template", "{rev}:{node|short} ({date|isodate})"]
-            version = subprocess.check_output(command)
-            return "%s-%s" % ("irked", version.decode("utf-8"))
-        except subprocess.CalledProcessError:
+            with open(version_file) as version:
+                return version.readline().strip() or "unknown"
+        except OSError:
+            self.logger.warning("No version file '%s', run mkversion.py",
+                                version_file)
             return "unknown"
 
-    def has_motd(self):
-        '''Indicates whether a message of the day is available.'''
-        return os.path.isfile(self.motd_file)
-
-    def motd(self):
-        '''Returns an iterable set of motd lines.'''
-        if os.path.isfile(self.motd_file):
-            for line in open(self.motd_file):
-                yield line.rstrip()
-
     def info(self):
         '''Returns an iterable set of info lines.'''
         yield "irked IRC daemon version %(version)s" % \
-            {'version' : self.gen_version()}
-        if os.path.isfile(self.info_file):
-            for line in open(self.info_file):
-                yield line.rstrip()
+            {'version' : self.version}
+        yield from self.info_text.get() or ()
+
+    def motd_block(self):
+        '''The MOTD as a pre-rendered ReplyBlock, or None if there is no
+        message of the day.'''
+        lines = self.motd_text.get()
+        if lines is None:
+            return None
+        if self._motd_block[0] != self.motd_text.serial:
+            replies = [(irc.RPL_MOTDSTART, dict(server=self.name))]
+            replies.extend((irc.RPL_MOTD, dict(motd_line=line))
+                           for line in lines)
+            replies.append((irc.RPL_ENDOFMOTD, None))
+            self._motd_block = (self.motd_text.serial,
+                                self.replies.block(replies))
+        return self._motd_block[1]
+
+    def info_block(self):
+        '''INFO replies as a pre-rendered ReplyBlock.'''
+        self.info_text.get()
+        if self._info_block[0] != self.info_text.serial:
+            replies = [(irc.RPL_INFO, dict(info=info)) for info in self.info()]
+            replies.append((irc.RPL_ENDOFINFO, None))
+            self._info_block = (self.info_text.serial,
+                                self.replies.block(replies))
+        return self._info_block[1]
+
+    def rehash(self):
+        '''Reload the MOTD and INFO text.'''
+        self.logger.info('Rehashing MOTD and INFO')
+        self.motd_text.reload()
+        self.info_text.reload()
+
+    def shutdown(self):
+        '''Called once the loop has stopped: let extensions and the
+        statistics database write what they still hold, then release the
+        resolver threads and the reactor.'''
+        self.logger.info('Shutting down')
+        self.extensions.shutdown()
+        if self.stats_db is not None:
+            self.stats_db.close()
+        if self.resolver is not None:
+            self.resolver.close()
+        self.reactor.close()
 
     def is_valid_oper_pass(self, username, password):
         if username not in self.config['opers']:
@@ -268,6 +463,18 @@ class IrcDispatcher(asyncore.dispatcher):
         #TODO O-line implementation
         return True
 
+def serve(server):
+    '''Run server until SIGTERM or SIGINT, then shut it down cleanly.'''
+    def stop(signum, frame):
+        server.reactor.call_soon_threadsafe(server.reactor.stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.reactor.loop()
+        server.shutdown()
+    finally:
+        stop_listeners()
+
 if __name__ == '__main__':
     epilog = 'Command line options have priority over config file values.'
     parser = argparse.ArgumentParser(description='irked IRC daemon.',
@@ -290,4 +497,4 @@ if __name__ == '__main__':
                            port=args.port,
                            name=args.name,
                            config=args.config)
-    asyncore.loop()
+    serve(server)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+'''Write the VERSION file read by irked at startup.
+
+Run this when building or deploying a release, from anywhere:
+    $ python3 mkversion.py
+The daemon itself never calls out to the version control system.'''
+import os.path
+import subprocess
+import sys
+
+# the working copy, where irked.py looks for VERSION
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+VERSION_FILE = os.path.join(SOURCE_DIR, 'VERSION')
+
+def hg_version():
+    branch = subprocess.check_output(["hg", "branch"], cwd=SOURCE_DIR)
+    command = ["hg", "heads",
+               branch.strip(),
+               "--template", "{rev}:{node|short} ({date|isodate})"]
+    return subprocess.check_output(command, cwd=SOURCE_DIR).decode("utf-8")
+
+def git_version():
+    command = ["git", "log", "-1", "--format=%h (%ci)"]
+    return subprocess.check_output(command, cwd=SOURCE_DIR).decode("utf-8")
+
+def gen_version():
+    for source in (hg_version, git_version):
+        try:
+            return "%s-%s" % ("irked", source().strip())
+        except (OSError, subprocess.CalledProcessError):
+            continue
+    return "unknown"
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else VERSION_FILE
+    version = gen_version()
+    with open(path, 'w') as version_file:
+        version_file.write(version + '\n')
+    print(version)